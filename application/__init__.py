@@ -2,11 +2,39 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_httpauth import HTTPBasicAuth
 from werkzeug.middleware.proxy_fix import ProxyFix
+from importlib import import_module
 from os import environ
+from . import compression
+from .cache import CredentialCache, StatusCache
+from .federation import FederationClient
 
 db = SQLAlchemy()
 #cors = CORS()
 httpauth = HTTPBasicAuth()
+status_cache = StatusCache()
+credential_cache = CredentialCache()
+federation_client = FederationClient()
+
+# Imported after db is defined, these work on the models
+from .admission import AdmissionControl
+from .events import EventHub
+from .metrics import Metrics
+from .transcoder import AvatarTranscoder
+from .webhooks import WebhookDispatcher
+event_hub = EventHub()
+webhook_dispatcher = WebhookDispatcher()
+metrics = Metrics()
+admission = AdmissionControl()
+avatar_transcoder = AvatarTranscoder()
+
+# Slow to import and only needed by some requests, these are loaded on
+# first use. Preloading them in the gunicorn master shares them with every
+# worker it forks.
+LAZY_MODULES = ('emoji_data', 'rfc3986', 'PIL.Image', 'magic', 'dateutil.parser')
+
+def preload_modules():
+  for name in LAZY_MODULES:
+    import_module(name)
 
 def init_app():
   app = Flask(__name__, instance_relative_config=False)
@@ -24,9 +52,22 @@ def init_app():
 
   # Initialize
   db.init_app(app)
+  compression.init_app(app)
+  status_cache.init_app(app)
+  credential_cache.init_app(app)
+  federation_client.init_app(app)
+  webhook_dispatcher.init_app(app)
+  event_hub.init_app(app)
+  avatar_transcoder.init_app(app)
+  metrics.init_app(app)
+  admission.init_app(app)
   with app.app_context():
     from . import auth, routes
-    db.create_all()
+    from .schema import create_schema
+    from .storage import configure_storage
+    configure_storage(app)
+    if app.config['SCHEMA_ON_STARTUP']:
+      create_schema(db.engine)
 
     return app
     
\ No newline at end of file
@@ -0,0 +1,262 @@
+from flask import Response, request
+from math import ceil
+from threading import Lock, local
+from time import perf_counter, time
+import sqlite3
+
+from .metrics import label_string
+from .process import ProcessStart
+
+def refill(tokens: float, updated: float, now: float, rate: float, burst: float):
+    return min(burst, tokens + max(0.0, now - updated) * rate)
+
+class MemoryBuckets:
+    # Token buckets kept by this worker alone. Buckets that have refilled
+    # completely are the same as missing ones and are pruned when many pile up.
+    def __init__(self, max_size: int = 100000):
+        self.max_size = max_size
+        self.buckets = {}  # key -> [tokens, updated]
+        self.lock = Lock()
+
+    def take(self, charges: list, now: float):
+        # charges are (key, cost, rate, burst). Either every bucket is charged
+        # or none; returns the charge that failed and its wait, or (None, 0).
+        with self.lock:
+            levels = []
+            for key, cost, rate, burst in charges:
+                bucket = self.buckets.get(key)
+                tokens = burst if bucket is None else refill(bucket[0], bucket[1], now, rate, burst)
+                if tokens < cost:
+                    return key, (cost - tokens) / rate
+                levels.append(tokens - cost)
+            for (key, _, _, _), tokens in zip(charges, levels):
+                self.buckets[key] = [tokens, now]
+            if len(self.buckets) > self.max_size:
+                self.prune(now, max(burst / rate for _, _, rate, burst in charges))
+        return None, 0
+
+    def prune(self, now: float, full_after: float):
+        for key in [key for key, (_, updated) in self.buckets.items() if now - updated > full_after]:
+            del self.buckets[key]
+
+class SQLiteBuckets:
+    # Token buckets shared by every worker through a small SQLite file, each
+    # decision taken in one write transaction
+    PRUNE_INTERVAL = 60  # Seconds between removals of refilled buckets
+
+    def __init__(self, file_path: str):
+        self.file_path = file_path
+        self.state = None
+        self.ensure_started = ProcessStart(self.start)
+        self.pruned = 0.0
+
+    def start(self):
+        self.state = local()
+
+    def connection(self):
+        # Each worker thread opens its own
+        self.ensure_started()
+        state = self.state
+        if getattr(state, 'connection', None) is None:
+            connection = sqlite3.connect(self.file_path, timeout=5, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=OFF")
+            connection.execute("CREATE TABLE IF NOT EXISTS buckets (key TEXT PRIMARY KEY, tokens REAL, updated REAL)")
+            state.connection = connection
+        return state.connection
+
+    def take(self, charges: list, now: float):
+        connection = self.connection()
+        keys = [key for key, _, _, _ in charges]
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            stored = dict((key, (tokens, updated)) for key, tokens, updated in connection.execute(
+                "SELECT key, tokens, updated FROM buckets WHERE key IN ({})".format(",".join("?" * len(keys))), keys))
+            levels = []
+            for key, cost, rate, burst in charges:
+                tokens = refill(*stored[key], now, rate, burst) if key in stored else burst
+                if tokens < cost:
+                    connection.execute("ROLLBACK")
+                    return key, (cost - tokens) / rate
+                levels.append((key, tokens - cost, now))
+            connection.executemany("INSERT OR REPLACE INTO buckets (key, tokens, updated) VALUES (?, ?, ?)", levels)
+            if now - self.pruned > self.PRUNE_INTERVAL:
+                self.pruned = now
+                full_after = max(burst / rate for _, _, rate, burst in charges)
+                connection.execute("DELETE FROM buckets WHERE updated < ?", (now - full_after,))
+            connection.execute("COMMIT")
+        except BaseException:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise
+        return None, 0
+
+class TimedInput:
+    # The request body stream, counting the time spent waiting for the
+    # client to send it
+    def __init__(self, stream):
+        self.stream = stream
+        self.waited = 0.0
+
+    def read(self, *args):
+        started = perf_counter()
+        try:
+            return self.stream.read(*args)
+        finally:
+            self.waited += perf_counter() - started
+
+    def readline(self, *args):
+        started = perf_counter()
+        try:
+            return self.stream.readline(*args)
+        finally:
+            self.waited += perf_counter() - started
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+class AdmissionControl:
+    # Decides before any work is done whether a request is served. Each
+    # request has a cost from ADMISSION_COSTS, charged to a token bucket for
+    # the client address and, when credentials are sent, one for the account
+    # they name; an empty bucket gets a 429. Requests are shed with a 503 while
+    # too many are in progress in this worker or recent ones have been slow.
+    LATENCY_HALF_LIFE = 5  # Seconds for the average latency to halve while no request finishes
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.buckets = None
+        self.lock = Lock()
+        self.in_flight = 0
+        # Moving average of the time admitted requests spent in their
+        # handlers, in seconds, and when it last changed
+        self.latency = 0.0
+        self.latency_updated = perf_counter()
+        self.state = local()
+        self.metrics = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = bool(app.config['ADMISSION_ENABLED'])
+        if not self.enabled:
+            return
+        self.costs = app.config['ADMISSION_COSTS']
+        self.client_limit = app.config['RATE_LIMIT_CLIENT']
+        self.account_limit = app.config['RATE_LIMIT_ACCOUNT']
+        self.max_in_flight = app.config['ADMISSION_MAX_IN_FLIGHT']
+        self.max_latency = app.config['ADMISSION_MAX_LATENCY']
+        self.retry_after = app.config['ADMISSION_RETRY_AFTER']
+        self.exempt = app.config['ADMISSION_EXEMPT']
+        self.upload_max_size = app.config['UPLOAD_MAX_SIZE']
+        self.batch_max_users = app.config['BATCH_MAX_USERS']
+        self.batch_max_body_size = app.config['BATCH_MAX_BODY_SIZE']
+        if app.config['RATE_LIMIT_DB']:
+            self.buckets = SQLiteBuckets(app.config['RATE_LIMIT_DB'])
+        else:
+            self.buckets = MemoryBuckets()
+        from application import metrics
+        self.metrics = metrics
+        # Registered after the metrics hooks, so rejected requests are counted
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        app.teardown_request(self.teardown_request)
+
+    def batch_users(self):
+        # Users named by a batch lookup, in the query string or in a form
+        # body small enough for the route to accept
+        if request.method == 'GET':
+            return len(request.args.getlist('user'))
+        size = request.content_length
+        if request.mimetype == 'application/x-www-form-urlencoded' and size is not None \
+                and size <= self.batch_max_body_size:
+            return len(request.form.getlist('user'))
+        return 0
+
+    def cost(self):
+        costs = self.costs
+        # Batches beyond BATCH_MAX_USERS are answered a page at a time, so
+        # each request is charged for one page at most
+        cost = costs['request'] + costs['batch_user'] * min(self.batch_users(), self.batch_max_users)
+        if request.method in ('PUT', 'POST', 'PATCH'):
+            size = request.content_length
+            cost += costs['upload_kib'] * (self.upload_max_size if size is None else size) / 1024
+        if request.authorization is not None:
+            cost += costs['auth']
+        return cost
+
+    def reject(self, reason: str, status: int, message: str, retry_after: float = None):
+        if self.metrics.enabled:
+            self.metrics.increment('flashpaper_admission_rejected_total', label_string(reason=reason))
+        response = Response(message, status=status)
+        if retry_after is not None:
+            response.headers['Retry-After'] = str(max(1, ceil(retry_after)))
+        return response
+
+    def recent_latency(self, now: float):
+        # Called with the lock held. The average fades while nothing
+        # finishes, so a few slow requests cannot keep a worker shedding.
+        return self.latency * 0.5 ** ((now - self.latency_updated) / self.LATENCY_HALF_LIFE)
+
+    def before_request(self):
+        self.state.started = None
+        if request.endpoint is None or request.endpoint in self.exempt:
+            return None
+
+        # Shed load before spending anything on the request
+        with self.lock:
+            if self.in_flight >= self.max_in_flight:
+                return self.reject('queue', 503, "Server busy", self.retry_after)
+            if self.max_latency and self.in_flight and self.recent_latency(perf_counter()) > self.max_latency:
+                return self.reject('latency', 503, "Server busy", self.retry_after)
+
+        # A request costing more than a bucket holds, such as the largest
+        # upload with credentials, is charged a full bucket, so every
+        # request the routes accept can be admitted
+        cost = self.cost()
+        charges = [("client:" + str(request.remote_addr), min(cost, self.client_limit[1])) + self.client_limit]
+        if request.authorization is not None and request.authorization.username:
+            charges.append(("account:" + request.authorization.username, min(cost, self.account_limit[1])) \
+                + self.account_limit)
+        key, wait = self.buckets.take(charges, time())
+        if key is not None:
+            return self.reject(key.split(":")[0], 429, "Too many requests", wait)
+
+        with self.lock:
+            self.in_flight += 1
+        # Time spent waiting for the client to send the body is not the
+        # handler's, so it is left out of the latency
+        self.state.input = TimedInput(request.environ['wsgi.input'])
+        request.environ['wsgi.input'] = self.state.input
+        self.state.started = perf_counter()
+        self.state.observed = False
+        if self.metrics.enabled:
+            self.metrics.increment('flashpaper_admission_admitted_total', "")
+        return None
+
+    def observe(self):
+        # Take the handler's time into the average once, when it returns,
+        # before a streamed response is sent
+        if self.state.observed:
+            return
+        self.state.observed = True
+        now = perf_counter()
+        elapsed = now - self.state.started - self.state.input.waited
+        with self.lock:
+            self.latency = self.recent_latency(now)
+            self.latency += (elapsed - self.latency) * 0.1
+            self.latency_updated = now
+
+    def after_request(self, response):
+        if self.state.started is not None:
+            self.observe()
+        return response
+
+    def teardown_request(self, exc):
+        if self.state.started is None:
+            return
+        # Handlers raising an exception skip after_request
+        self.observe()
+        self.state.started = None
+        with self.lock:
+            self.in_flight -= 1
@@ -1,5 +1,6 @@
-from application import httpauth
-from .models import User, UserAvatar, UserStatus, UserFollow
+from application import credential_cache, httpauth, metrics, status_cache
+from .avatars import release_avatar
+from .models import User, UserAvatar, UserChange, UserStatus, UserFollow
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
 import re
@@ -7,7 +8,15 @@ import re
 @httpauth.verify_password
 def verify_password(username, password):
     user = User.query.filter_by(username=username).first()
-    if user and check_password_hash(user.password, password):
+    if user is None:
+        return False
+    # Skip the password hash check for credentials verified moments ago
+    if credential_cache.check(username, password, user.password):
+        return user
+    with metrics.timer('check_password_hash'):
+        valid = check_password_hash(user.password, password)
+    if valid:
+        credential_cache.add(username, password, user.password)
         return user
     return False
 
@@ -25,13 +34,29 @@ def create_user(username, password):
     new_user.last_updated = datetime.utcnow().replace(microsecond=0)
     new_user.follows_updated = datetime.utcnow().replace(microsecond=0)
     new_user.webhooks_updated = datetime.utcnow().replace(microsecond=0)
+    UserChange.record(username, 'status')
     new_user.save()
     print("User '{}' created.".format(username))
 
+def set_user_password(username, password):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        print("User does not exist.")
+        return
+    user.password = generate_password_hash(password, method='sha256')
+    user.save()
+    credential_cache.invalidate(username)
+    print("Password for '{}' updated.".format(username))
+
 def delete_user(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         print("User does not exist.")
         return
+    UserChange.record(username, 'deleted')
+    remove_files = release_avatar(user.avatar, username)
     user.delete()
+    remove_files()
+    status_cache.invalidate(username)
+    credential_cache.invalidate(username)
     print("User '{}' deleted".format(username))
\ No newline at end of file
@@ -0,0 +1,347 @@
+from application import avatar_transcoder, db, metrics
+from .models import AvatarBlob, UserAvatar
+from flask import current_app as app
+from flask import Response, send_from_directory
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+from collections import namedtuple
+from datetime import datetime
+from hashlib import sha256
+from os import listdir, makedirs, path, remove, replace, rmdir
+from tempfile import NamedTemporaryFile
+import struct
+
+# Upload spooled to a temporary file in the avatars directory
+SpooledUpload = namedtuple('SpooledUpload', ['path', 'byte_size', 'digest'])
+
+# Alternative encodings made by the transcoder, by MIME type
+ENCODING_TYPES = {'avif': 'image/avif', 'webp': 'image/webp'}
+
+# Blob storage within the avatars directory. Usernames cannot contain a
+# hyphen, so it never collides with an avatar stored under a username.
+BLOB_DIR = "blobs-sha256"
+
+def avatar_filename(username: str, size: int = None):
+    # Where avatars uploaded before blob storage live, see migrate_avatar().
+    # Usernames never contain a dot, so variants cannot collide with users.
+    if size is None:
+        return username
+    return "{}.{}".format(username, size)
+
+def avatar_path(username: str, size: int = None):
+    return safe_join(app.config['AVATARS_DIR'], avatar_filename(username, size))
+
+def blob_filename(digest: str, size: int = None, encoding: str = None):
+    # Images are named by their SHA-256 and sharded over 65536 directories
+    # by its first two bytes, keeping every directory small
+    name = digest if size is None else "{}.{}".format(digest, size)
+    if encoding is not None:
+        name = "{}.{}".format(name, encoding)
+    return "/".join((BLOB_DIR, digest[0:2], digest[2:4], name))
+
+def blob_path(digest: str, size: int = None, encoding: str = None):
+    return safe_join(app.config['AVATARS_DIR'], blob_filename(digest, size, encoding))
+
+def is_blob(avatar):
+    # Avatars stored as blobs use their digest as URL key, older ones the
+    # time of upload
+    return avatar.digest is not None and avatar.original_key == avatar.digest
+
+def stored_filename(avatar, username: str, size: int = None, encoding: str = None):
+    if is_blob(avatar):
+        return blob_filename(avatar.digest, size, encoding)
+    return avatar_filename(username, size)
+
+def preferred_encoding(avatar, accept):
+    # The smallest encoding of a blob the client names in its Accept header,
+    # or None for the uploaded format. Wildcards do not count, as they are
+    # sent by clients that cannot decode newer formats.
+    if not is_blob(avatar) or not avatar.encodings:
+        return None
+    for encoding in avatar.encodings.split(","):
+        if any(value == ENCODING_TYPES.get(encoding) and quality > 0 for value, quality in accept):
+            return encoding
+    return None
+
+def png_dimensions(chunk: bytes):
+    # Width and height from the IHDR chunk every PNG starts with, or None
+    if len(chunk) < 24 or chunk[12:16] != b"IHDR":
+        return None
+    return struct.unpack(">II", chunk[16:24])
+
+def parse_sizes(sizes: str):
+    if not sizes:
+        return []
+    return [int(size) for size in sizes.split(",")]
+
+def temporary_file(directory: str = None):
+    # Temporary names start with a dot, which no username or variant does
+    return NamedTemporaryFile(dir=directory or app.config['AVATARS_DIR'], prefix=".upload-", delete=False)
+
+def discard_file(file_path: str):
+    try:
+        remove(file_path)
+    except FileNotFoundError:
+        pass
+
+def spool_upload(stream, chunk: bytes):
+    # Copy the request body to disk a chunk at a time, hashing it on the way.
+    # Returns None as soon as the upload exceeds UPLOAD_MAX_SIZE.
+    byte_size = 0
+    digest = sha256()
+    with temporary_file() as file:
+        while chunk:
+            byte_size += len(chunk)
+            if byte_size > app.config['UPLOAD_MAX_SIZE']:
+                break
+            digest.update(chunk)
+            file.write(chunk)
+            chunk = stream.read(app.config['UPLOAD_CHUNK_SIZE'])
+    if byte_size > app.config['UPLOAD_MAX_SIZE']:
+        discard_file(file.name)
+        return None
+    return SpooledUpload(file.name, byte_size, digest.hexdigest())
+
+def draft_within(img, max_pixels: int):
+    # Have a JPEG decoded at the largest scale within max_pixels. Returns
+    # whether the image fits once decoded, checked before any pixel is.
+    scale = 1
+    while img.width * img.height > max_pixels * scale * scale and scale < 8:
+        scale *= 2
+    if scale > 1:
+        img.draft(img.mode, (img.width // scale, img.height // scale))
+    return img.width * img.height <= max_pixels
+
+def render_variants(img):
+    # Write a downscaled copy for every configured size smaller than the
+    # original to temporary files. Returns the sizes and the files.
+    from PIL import Image
+    image_format = img.format
+    sizes = [size for size in sorted(app.config['AVATAR_SIZES']) if size < img.width]
+    if sizes:
+        # JPEGs can be decoded at a reduced scale that still covers every
+        # variant. Other formats decode in full, so the pixels that would be
+        # held are checked before anything is decoded.
+        img.draft(img.mode, (sizes[-1], sizes[-1]))
+        if img.width * img.height > app.config['AVATAR_MAX_DECODED_PIXELS']:
+            raise Image.DecompressionBombError("Image of {}x{} pixels is too large to decode".format(img.width, img.height))
+        if img.mode in {"1", "P"}:
+            img = img.convert("RGBA")
+
+    rendered = []
+    try:
+        # Largest first, each variant from the previous one, which is shrunk
+        # with reduce() close to the target before the Lanczos pass
+        for size in reversed(sizes):
+            img = img.resize((size, size), Image.LANCZOS, reducing_gap=3.0)
+            with temporary_file() as file:
+                rendered.append(file.name)
+                # JPEG writes the colour profile only when passed
+                img.save(file, format=image_format, icc_profile=img.info.get("icc_profile"))
+    except BaseException:
+        for file_path in rendered:
+            discard_file(file_path)
+        raise
+    rendered.reverse()
+    return sizes, rendered
+
+def install_file(file_path: str, target: str):
+    # Move a file into blob storage, recreating its shard directory should
+    # purge_blob() have removed it meanwhile
+    for attempt in range(2):
+        makedirs(path.dirname(target), exist_ok=True)
+        try:
+            replace(file_path, target)
+            return
+        except FileNotFoundError:
+            if attempt or not path.exists(file_path):
+                raise
+
+def acquire_blob(upload: SpooledUpload, img):
+    # Take a reference to the blob holding this image, storing the upload
+    # and its variants first if no avatar shows it yet. Returns the variant
+    # sizes, the blob's encodings and whether it was stored. Writing the
+    # row takes the write lock before any file is moved into place, so a
+    # purge of the same digest cannot remove them.
+    table = AvatarBlob.__table__
+    for attempt in range(3):
+        blob = db.session.query(AvatarBlob.refcount, AvatarBlob.sizes, AvatarBlob.encodings) \
+            .filter_by(digest=upload.digest).first()
+        if blob is not None and blob.refcount > 0:
+            result = db.session.execute(update(table).where(table.c.digest == upload.digest, table.c.refcount > 0)
+                .values(refcount=table.c.refcount + 1))
+            if result.rowcount:
+                return parse_sizes(blob.sizes), blob.encodings, False
+            continue
+
+        sizes, rendered = render_variants(img)
+        # Without an encoder there is nothing to wait for
+        encodings = None if avatar_transcoder.available() else ""
+        values = {"refcount": 1, "sizes": ",".join(str(size) for size in sizes), "encodings": encodings}
+        try:
+            if blob is None:
+                db.session.execute(insert(table), dict(values, digest=upload.digest))
+                stored = True
+            else:
+                # Released by every avatar but not purged yet, so its files
+                # may be gone; it is stored again
+                stored = db.session.execute(update(table)
+                    .where(table.c.digest == upload.digest, table.c.refcount <= 0).values(**values)).rowcount
+        except IntegrityError:
+            # Stored by a concurrent upload of the same image
+            db.session.rollback()
+            stored = False
+        if not stored:
+            for file_path in rendered:
+                discard_file(file_path)
+            continue
+        for size, file_path in zip(sizes, rendered):
+            install_file(file_path, blob_path(upload.digest, size))
+        install_file(upload.path, blob_path(upload.digest))
+        return sizes, encodings, True
+    raise RuntimeError("Blob {} kept changing while being acquired".format(upload.digest))
+
+def release_blob(digest: str):
+    # Drop a reference to a blob. Its files stay until purge_blob() is
+    # called once the transaction has committed.
+    table = AvatarBlob.__table__
+    db.session.execute(update(table).where(table.c.digest == digest).values(refcount=table.c.refcount - 1))
+
+def purge_blob(digest: str):
+    # Delete a blob no avatar shows any more, with its files. The row goes
+    # first, so the write lock is held while the files are removed and an
+    # upload of the same image waits, then stores it afresh. Should the
+    # commit fail, the row is left unreferenced and stored again by the
+    # next upload of the image.
+    table = AvatarBlob.__table__
+    if db.session.execute(delete(table).where(table.c.digest == digest, table.c.refcount <= 0)).rowcount:
+        remove_blob_files(digest)
+    db.session.commit()
+
+def remove_blob_files(digest: str):
+    directory = path.dirname(blob_path(digest))
+    try:
+        names = listdir(directory)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if name == digest or name.startswith(digest + "."):
+            discard_file(path.join(directory, name))
+    # Drop the shard directories once empty
+    for shard in (directory, path.dirname(directory)):
+        try:
+            rmdir(shard)
+        except OSError:
+            break
+
+def release_avatar(avatar, username: str):
+    # Give up the image an avatar shows before it is replaced or deleted.
+    # Returns a call removing the files, to be made after commit so that a
+    # failed commit leaves the image in place.
+    if avatar is None or avatar.original is None:
+        return lambda: None
+    if is_blob(avatar):
+        digest = avatar.digest
+        release_blob(digest)
+        return lambda: purge_blob(digest)
+    file_paths = [avatar_path(username)] + [avatar_path(username, size) for size in parse_sizes(avatar.sizes)]
+    def remove_files():
+        for file_path in file_paths:
+            discard_file(file_path)
+    return remove_files
+
+def replace_avatar(avatar_id: int, username: str, values: dict):
+    # Point an avatar at a new image and release the one it showed. The row
+    # is only changed while it still shows the image read just before, so
+    # of two uploads racing for the same user the second releases what the
+    # first installed, rather than both releasing the old image. Returns
+    # release_avatar()'s call, or None when the avatar is gone.
+    table = UserAvatar.__table__
+    while True:
+        current = db.session.execute(select(table.c.original, table.c.sizes, table.c.digest, table.c.original_key)
+            .where(table.c.id == avatar_id)).first()
+        if current is None:
+            return None
+        if current.original_key is None:
+            unchanged = table.c.original_key.is_(None)
+        else:
+            unchanged = table.c.original_key == current.original_key
+        if db.session.execute(update(table).where(table.c.id == avatar_id, unchanged).values(**values)).rowcount:
+            return release_avatar(current, username)
+
+def migrate_avatar(avatar, username: str):
+    # Move an avatar stored under its username into blob storage, sharing
+    # the blob if another avatar already shows the same image. Returns the
+    # call to make after commit, as release_avatar() does, or None when the
+    # original is missing.
+    if avatar.digest is None and not inspect_avatar(avatar, username):
+        return None
+    table = AvatarBlob.__table__
+    sizes = parse_sizes(avatar.sizes)
+    result = db.session.execute(update(table).where(table.c.digest == avatar.digest, table.c.refcount > 0)
+        .values(refcount=table.c.refcount + 1))
+    if result.rowcount:
+        remove_files = release_avatar(avatar, username)
+        avatar.sizes = db.session.query(AvatarBlob.sizes).filter_by(digest=avatar.digest).scalar()
+    else:
+        # A blob released by every avatar but not purged yet is stored again
+        values = {"refcount": 1, "sizes": avatar.sizes, "encodings": None}
+        if not db.session.execute(update(table).where(table.c.digest == avatar.digest).values(**values)).rowcount:
+            db.session.execute(insert(table), dict(values, digest=avatar.digest))
+        for size in sizes:
+            if path.exists(avatar_path(username, size)):
+                install_file(avatar_path(username, size), blob_path(avatar.digest, size))
+        install_file(avatar_path(username), blob_path(avatar.digest))
+        remove_files = lambda: None
+    if avatar.updated is None:
+        avatar.updated = avatar_last_modified(avatar)
+    avatar.original_key = avatar.digest
+    return remove_files
+
+def closest_variant(sizes: list, requested: int):
+    # Smallest variant at least as large as requested, or the original (None)
+    for size in sorted(sizes):
+        if size >= requested:
+            return size
+    return None
+
+def avatar_etag(avatar, size: int = None, encoding: str = None):
+    etag = avatar.digest if size is None else "{}-{}".format(avatar.digest, size)
+    if encoding is not None:
+        etag = "{}-{}".format(etag, encoding)
+    return etag
+
+def avatar_last_modified(avatar):
+    if avatar.updated is not None:
+        return avatar.updated
+    return datetime.utcfromtimestamp(int(avatar.original_key))
+
+def inspect_avatar(avatar, username: str):
+    # Avatars uploaded before metadata was recorded get inspected once
+    import magic
+    image_path = avatar_path(username)
+    if not path.exists(image_path):
+        return False
+    digest = sha256()
+    with open(image_path, "rb") as file:
+        for chunk in iter(lambda: file.read(65536), b""):
+            digest.update(chunk)
+    with metrics.timer('magic'):
+        avatar.mime_type = magic.from_file(image_path, mime=True)
+    avatar.byte_size = path.getsize(image_path)
+    avatar.digest = digest.hexdigest()
+    return True
+
+def send_avatar(filename: str, mime_type: str, etag: str, last_modified: datetime):
+    # Hand the body off to the reverse proxy when configured to
+    if app.config['AVATAR_ACCEL_REDIRECT']:
+        response = Response(None, status=200, mimetype=mime_type)
+        response.headers['X-Accel-Redirect'] = app.config['AVATAR_ACCEL_REDIRECT'] + filename
+        return response
+    try:
+        return send_from_directory(app.config['AVATARS_DIR'], filename, mimetype=mime_type,
+            etag=etag, last_modified=last_modified, max_age=app.config['AVATAR_MAX_AGE'])
+    except NotFound:
+        return Response("No such image found.", status=404)
@@ -0,0 +1,116 @@
+from collections import OrderedDict, namedtuple
+from hashlib import blake2b, sha256
+from secrets import token_bytes
+from threading import Lock
+from time import monotonic
+import hmac
+
+# Serialized fmrl status for a single user, plus the validators sent with it
+StatusEntry = namedtuple('StatusEntry', ['data', 'last_updated', 'last_modified', 'etag'])
+
+def status_entry(data: bytes, last_updated, last_modified: str):
+    etag = blake2b(data + last_modified.encode('utf-8'), digest_size=12).hexdigest()
+    return StatusEntry(data, last_updated, last_modified, etag)
+
+class StatusCache:
+    # Bounded LRU of serialized user statuses, keyed by username. Entries are
+    # only trusted while their last_updated matches the database, so writes
+    # made by other workers are picked up on the next read.
+    def __init__(self, app=None):
+        self.max_size = 0
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.max_size = app.config['STATUS_CACHE_SIZE']
+        self.clear()
+
+    def get(self, username: str, last_updated):
+        with self.lock:
+            entry = self.entries.get(username)
+            if entry is None or entry.last_updated != last_updated:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(username)
+            self.hits += 1
+            return entry
+
+    def put(self, username: str, entry: StatusEntry):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            self.entries[username] = entry
+            self.entries.move_to_end(username)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries), "max_size": self.max_size}
+
+class CredentialCache:
+    # Short-lived record of recently verified HTTP Basic credentials. Only an
+    # HMAC of the username, password and stored password hash is kept, under a
+    # key generated per process, so a changed password never matches.
+    def __init__(self, app=None):
+        self.ttl = 0
+        self.max_size = 0
+        self.key = token_bytes(32)
+        self.entries = {}
+        self.lock = Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.ttl = app.config['AUTH_CACHE_TTL']
+        self.max_size = app.config['AUTH_CACHE_SIZE']
+        self.clear()
+
+    def digest(self, username: str, password: str, password_hash: str):
+        message = "\0".join((username, password, password_hash)).encode('utf-8')
+        return hmac.new(self.key, message, sha256).digest()
+
+    def check(self, username: str, password: str, password_hash: str):
+        if self.ttl <= 0:
+            return False
+        with self.lock:
+            entry = self.entries.get(username)
+        if entry is None or entry[0] < monotonic():
+            return False
+        return hmac.compare_digest(entry[1], self.digest(username, password, password_hash))
+
+    def add(self, username: str, password: str, password_hash: str):
+        if self.ttl <= 0 or self.max_size <= 0:
+            return
+        digest = self.digest(username, password, password_hash)
+        now = monotonic()
+        with self.lock:
+            self.entries.pop(username, None)
+            if len(self.entries) >= self.max_size:
+                for key in [key for key, entry in self.entries.items() if entry[0] < now]:
+                    del self.entries[key]
+            while len(self.entries) >= self.max_size:
+                del self.entries[next(iter(self.entries))]
+            self.entries[username] = (now + self.ttl, digest)
+
+    def invalidate(self, username: str):
+        with self.lock:
+            self.entries.pop(username, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
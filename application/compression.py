@@ -0,0 +1,53 @@
+from flask import current_app as app
+from flask import request
+import gzip
+import zlib
+
+# Brotli is optional, gzip is used when it is not installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+def init_app(flask_app):
+    flask_app.after_request(compress_response)
+
+def compress_response(response):
+    # Compress JSON bodies for clients that accept it. Small bodies are sent
+    # as they are, and streamed ones are gzipped as they are produced.
+    if response.mimetype != 'application/json' or response.status_code != 200 \
+            or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if response.is_streamed:
+        if request.accept_encodings['gzip']:
+            response.response = gzip_stream(response.response, app.config['COMPRESSION_GZIP_LEVEL'])
+            response.headers['Content-Encoding'] = 'gzip'
+        return response
+    body = response.get_data()
+    if len(body) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        response.set_data(brotli.compress(body, quality=app.config['COMPRESSION_BROTLI_QUALITY']))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepted['gzip']:
+        response.set_data(gzip.compress(body, compresslevel=app.config['COMPRESSION_GZIP_LEVEL']))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def gzip_stream(chunks, level: int):
+    # Flush after every chunk so each reaches the client without waiting for
+    # the next one
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        # Closing the source ends the request context it may hold
+        if hasattr(chunks, 'close'):
+            chunks.close()
@@ -0,0 +1,119 @@
+from application import db
+from .models import UserChange
+from .process import ProcessStart
+from sqlalchemy import func
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+
+class Subscription:
+    # Usernames a client listens to, and those changed since it last looked.
+    # Repeated changes to one user collapse into a single pending entry.
+    def __init__(self, usernames: set):
+        self.usernames = usernames
+        self.pending = set()
+        self.condition = Condition()
+
+    def push(self, username: str):
+        with self.condition:
+            self.pending.add(username)
+            self.condition.notify()
+
+    def wait(self, timeout: float):
+        deadline = monotonic() + timeout
+        with self.condition:
+            while not self.pending and monotonic() < deadline:
+                self.condition.wait(deadline - monotonic())
+            changed, self.pending = self.pending, set()
+        return changed
+
+class EventHub:
+    # In-process publish/subscribe of status changes. Updates made by this
+    # worker are published as they commit; a poller following the change
+    # log picks up changes committed by other workers.
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = Lock()
+        self.subscribers = {}  # username -> set of Subscription
+        self.count = 0
+        self.versions = {}  # username -> change sequence already published
+        self.watermark = None  # Latest change the poller has seen, while anyone listens
+        self.ensure_started = ProcessStart(self.start)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.max_subscribers = app.config['EVENTS_MAX_SUBSCRIBERS']
+        if not app.config['ASYNC_MODE']:
+            # Streams hold a thread each, which other requests need as well
+            self.max_subscribers = min(self.max_subscribers,
+                max(0, app.config['WORKER_THREADS'] - app.config['EVENTS_RESERVED_THREADS']))
+        self.poll_interval = app.config['EVENTS_POLL_INTERVAL']
+
+    def subscribe(self, usernames: set):
+        # Returns None once EVENTS_MAX_SUBSCRIBERS clients are connected.
+        # Called before the subscriber's first snapshot is read, so that the
+        # poller follows every change the snapshot may miss.
+        seq = db.session.query(func.max(UserChange.seq)).scalar() or 0
+        with self.lock:
+            if self.count >= self.max_subscribers:
+                return None
+            self.ensure_started()
+            subscription = Subscription(usernames)
+            for username in usernames:
+                self.subscribers.setdefault(username, set()).add(subscription)
+            self.count += 1
+            if self.watermark is None:
+                self.watermark = seq
+            return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.lock:
+            for username in subscription.usernames:
+                listeners = self.subscribers.get(username)
+                if listeners is None:
+                    continue
+                listeners.discard(subscription)
+                if not listeners:
+                    del self.subscribers[username]
+                    self.versions.pop(username, None)
+            self.count -= 1
+
+    def publish(self, username: str, seq: int):
+        with self.lock:
+            if username not in self.subscribers or self.versions.get(username, 0) >= seq:
+                return
+            self.versions[username] = seq
+            listeners = list(self.subscribers[username])
+        for subscription in listeners:
+            subscription.push(username)
+
+    def start(self):
+        self.subscribers.clear()
+        self.versions.clear()
+        self.watermark = None
+        self.count = 0
+        Thread(target=self.poll, name="event-poller", daemon=True).start()
+
+    def poll(self):
+        while True:
+            sleep(self.poll_interval)
+            with self.lock:
+                if not self.subscribers:
+                    self.watermark = None
+                    continue
+                watermark = self.watermark
+            try:
+                with self.app.app_context():
+                    changes = db.session.query(UserChange.username, UserChange.seq) \
+                        .filter(UserChange.seq > watermark, UserChange.kind.in_(UserChange.STATUS_KINDS)).all()
+            except Exception:
+                self.app.logger.exception("Polling for status changes failed")
+                continue
+
+            for username, seq in changes:
+                watermark = max(watermark, seq)
+                self.publish(username, seq)
+            with self.lock:
+                if self.watermark is not None:
+                    self.watermark = max(self.watermark, watermark)
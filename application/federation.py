@@ -0,0 +1,129 @@
+from .cache import status_entry
+from .pool import AddressPolicy, ConnectionPool
+from .process import ProcessStart
+from flask import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from calendar import timegm
+from http.client import HTTPException
+from threading import Lock
+from time import monotonic
+from urllib.parse import urlencode, urlparse
+
+class FederationClient:
+    # Fetches statuses of accounts on other fmrl servers with one batched
+    # request per host, run concurrently. Results are shared by every local
+    # user through a bounded cache, kept for FEDERATION_CACHE_TTL and then
+    # revalidated upstream with If-Modified-Since.
+    def __init__(self, app=None):
+        self.entries = OrderedDict()  # address -> (StatusEntry or None, fetched)
+        self.lock = Lock()
+        self.ensure_started = ProcessStart(self.start)
+        self.executor = None
+        self.pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.scheme = app.config['FEDERATION_SCHEME']
+        self.endpoints = app.config['FEDERATION_ENDPOINTS']
+        self.workers = app.config['FEDERATION_WORKERS']
+        self.timeout = app.config['FEDERATION_TIMEOUT']
+        self.batch_size = app.config['FEDERATION_BATCH_SIZE']
+        self.ttl = app.config['FEDERATION_CACHE_TTL']
+        self.max_size = app.config['FEDERATION_CACHE_SIZE']
+        # Followed hosts are chosen by users, endpoint overrides by the operator
+        self.policy = AddressPolicy(app.config['OUTBOUND_ALLOW'], app.config['OUTBOUND_DENY'],
+            trusted_hosts=[urlparse(base).hostname for base in self.endpoints.values()])
+        with self.lock:
+            self.entries.clear()
+
+    def start(self):
+        self.pool = ConnectionPool(timeout=self.timeout, max_idle=self.workers, policy=self.policy)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="federation")
+
+    def fetch(self, addresses: list):
+        # Returns StatusEntry objects for found accounts and (code, message)
+        # tuples for accounts that could not be resolved
+        results = {}
+        stale = {}
+        now = monotonic()
+        with self.lock:
+            for address in addresses:
+                cached = self.entries.get(address)
+                if cached is not None and cached[1] + self.ttl > now:
+                    self.entries.move_to_end(address)
+                    results[address] = cached[0] or (404, "No such user")
+                else:
+                    host = address.rsplit("@", 1)[1].lower()
+                    stale.setdefault(host, []).append(address)
+
+        if stale:
+            self.ensure_started()
+            requests = []
+            for host, host_addresses in stale.items():
+                for i in range(0, len(host_addresses), self.batch_size):
+                    requests.append((host, host_addresses[i:i + self.batch_size]))
+            for fetched in self.executor.map(lambda request: self.fetch_host(*request), requests):
+                results.update(fetched)
+        return results
+
+    def fetch_host(self, host: str, addresses: list):
+        from dateutil.parser import parse as parsedate
+        with self.lock:
+            cached = {address: self.entries[address] for address in addresses if address in self.entries}
+
+        # Revalidate with the oldest timestamp when every account is cached
+        headers = {"User-Agent": "flashpaper", "Accept": "application/json"}
+        known = [entry.last_updated for entry, _ in cached.values() if entry is not None]
+        if len(known) == len(addresses):
+            headers["If-Modified-Since"] = formatdate(timeval=timegm(min(known).timetuple()), localtime=False, usegmt=True)
+
+        base = self.endpoints.get(host, "{}://{}".format(self.scheme, host))
+        query = urlencode([("user", address.split("@")[1]) for address in addresses])
+        try:
+            response, body = self.pool.request("GET", "{}/.well-known/fmrl/users?{}".format(base, query), headers=headers)
+            if response.status != 200:
+                raise ValueError("Unexpected status {}".format(response.status))
+            statuses = {item["username"]: item for item in json.loads(body)}
+            fetched_at = parsedate(response.headers["Date"]).replace(tzinfo=None) \
+                if response.headers.get("Date") else datetime.utcnow()
+        except (OSError, HTTPException, ValueError, TypeError, KeyError):
+            # Serve whatever is cached, even if it has expired
+            return {address: cached[address][0] if address in cached and cached[address][0] is not None
+                else (502, "Upstream server unavailable") for address in addresses}
+
+        # Updates in the same second as the response may still be missing, so
+        # later revalidation starts a second earlier
+        last_updated = fetched_at.replace(microsecond=0) - timedelta(seconds=1)
+        results = {}
+        now = monotonic()
+        with self.lock:
+            for address in addresses:
+                item = statuses.get(address.split("@")[1])
+                code = item.get("code") if isinstance(item, dict) else None
+                if code == 200:
+                    data = json.dumps(item.get("data", {})).encode('utf-8')
+                    previous = cached.get(address, (None,))[0]
+                    if previous is not None and previous.data == data:
+                        # Unchanged, though sent again, so it keeps the time
+                        # it was first seen
+                        entry = previous
+                    else:
+                        entry = status_entry(data=data, last_updated=last_updated,
+                            last_modified=formatdate(timeval=timegm(last_updated.timetuple()), localtime=False, usegmt=True))
+                elif code == 304 and address in cached:
+                    entry = cached[address][0]
+                elif code == 404:
+                    entry = None
+                else:
+                    results[address] = (502, "Invalid upstream response")
+                    continue
+                self.entries[address] = (entry, now)
+                self.entries.move_to_end(address)
+                results[address] = entry or (404, "No such user")
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+        return results
@@ -0,0 +1,224 @@
+from application import db
+from .models import User, UserAvatar, UserChange, UserStatus
+from .validation import STATUS_FIELDS, validate_status_update
+from flask import current_app as app
+from sqlalchemy import delete, insert
+from sqlalchemy.exc import IntegrityError
+from werkzeug.security import generate_password_hash
+from contextlib import nullcontext
+from datetime import datetime
+from itertools import islice
+from multiprocessing import Pool
+from time import monotonic
+from os import path, remove, replace
+import csv
+import json
+import re
+
+# Same rule as create_user
+USERNAME = re.compile(r"^[a-zA-Z0-9_]{1,40}$")
+
+# Reported individually before only counting
+MAX_REPORTED_ERRORS = 20
+
+def hash_password(password: str):
+    return generate_password_hash(password, method='sha256')
+
+def is_password_hash(value: str):
+    # Werkzeug hashes look like method$salt$hash
+    return isinstance(value, str) and value.count("$") == 2 and all(value.split("$"))
+
+def read_records(file, file_format: str):
+    # Yields (line number, record) pairs from a CSV file with a header row or
+    # from JSON Lines. Empty CSV cells count as missing, and lines that are
+    # not JSON objects give None.
+    if file_format == 'csv':
+        reader = csv.DictReader(file)
+        for record in reader:
+            yield reader.line_num, {key: value for key, value in record.items() if key and value not in (None, "")}
+        return
+    for line_number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        yield line_number, record if isinstance(record, dict) else None
+
+def status_fields(record: dict):
+    # Optional status columns, checked like a status PATCH
+    update = {field: record[field] for field in STATUS_FIELDS if field in record}
+    if isinstance(update.get('media_type'), str):
+        try:
+            update['media_type'] = int(update['media_type'])
+        except ValueError:
+            pass
+    return validate_status_update(update)
+
+class UserImport:
+    # Creates users in bulk from CSV or JSON Lines. Each record has a
+    # username, a password or a precomputed password_hash, and optionally
+    # status fields. Passwords are hashed on a process pool, and users are
+    # written batch_size at a time, each batch in one transaction. The
+    # number of records handled is kept in a progress file after every
+    # batch so an interrupted import can resume where it stopped.
+    def __init__(self, input_path: str, file_format: str = None, workers: int = 1, batch_size: int = 1000,
+            dry_run: bool = False, progress_path: str = None):
+        self.input_path = input_path
+        self.file_format = file_format or ('csv' if input_path.lower().endswith('.csv') else 'jsonl')
+        self.workers = workers
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.progress_path = progress_path or input_path + ".progress"
+        self.chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+        self.seen = set()
+        self.counts = {"imported": 0, "existing": 0, "invalid": 0, "duplicate": 0}
+        self.errors = 0
+        self.elapsed = 0.0
+
+    def error(self, line_number: int, message: str):
+        self.errors += 1
+        if self.errors <= MAX_REPORTED_ERRORS:
+            print("Line {}: {}".format(line_number, message))
+        elif self.errors == MAX_REPORTED_ERRORS + 1:
+            print("Further errors are only counted.")
+
+    def load_progress(self):
+        if not path.exists(self.progress_path):
+            return 0
+        with open(self.progress_path) as file:
+            progress = json.load(file)
+        if progress.get("input") != path.abspath(self.input_path):
+            raise ValueError("{} belongs to another import".format(self.progress_path))
+        return progress["records"]
+
+    def save_progress(self, records: int):
+        with open(self.progress_path + ".tmp", 'w') as file:
+            json.dump({"input": path.abspath(self.input_path), "records": records}, file)
+        replace(self.progress_path + ".tmp", self.progress_path)
+
+    def run(self, resume: bool = False):
+        skip = self.load_progress() if resume else 0
+        if skip:
+            print("Resuming after {} records.".format(skip))
+        started = monotonic()
+        done = skip
+        with open(self.input_path, newline='') as file:
+            records = islice(read_records(file, self.file_format), skip, None)
+            with (Pool(self.workers) if self.workers > 1 and not self.dry_run else nullcontext()) as pool:
+                while True:
+                    batch = list(islice(records, self.batch_size))
+                    if not batch:
+                        break
+                    self.import_batch(batch, pool)
+                    done += len(batch)
+                    if not self.dry_run:
+                        self.save_progress(done)
+                    self.elapsed = monotonic() - started
+                    print("{} records, {} users {} ({:.1f}k users/s)".format(
+                        done, self.counts["imported"], "to import" if self.dry_run else "imported",
+                        self.counts["imported"] / self.elapsed / 1000 if self.elapsed else 0))
+        if not self.dry_run and path.exists(self.progress_path):
+            remove(self.progress_path)
+        return self.counts
+
+    def validate(self, batch: list):
+        # Check the whole batch at once, then look up which usernames exist
+        usernames = [record.get('username') if record is not None else None for _, record in batch]
+        valid = [isinstance(name, str) and USERNAME.match(name) is not None for name in usernames]
+        candidates = []
+        for (line_number, record), username, is_valid in zip(batch, usernames, valid):
+            if record is None:
+                self.counts["invalid"] += 1
+                self.error(line_number, "not a JSON object")
+                continue
+            if not is_valid:
+                self.counts["invalid"] += 1
+                self.error(line_number, "invalid username {!r}".format(username))
+                continue
+            if username in self.seen:
+                self.counts["duplicate"] += 1
+                self.error(line_number, "duplicate username {!r}".format(username))
+                continue
+            password_hash = record.get('password_hash')
+            password = record.get('password')
+            if password_hash is not None and not is_password_hash(password_hash):
+                self.counts["invalid"] += 1
+                self.error(line_number, "invalid password hash for {!r}".format(username))
+                continue
+            if password_hash is None and (not isinstance(password, str) or not password):
+                self.counts["invalid"] += 1
+                self.error(line_number, "missing password for {!r}".format(username))
+                continue
+            status, status_error = status_fields(record)
+            if status_error is not None:
+                self.counts["invalid"] += 1
+                self.error(line_number, "invalid status for {!r}: {}".format(username, status_error[1]))
+                continue
+            self.seen.add(username)
+            candidates.append((username, password_hash, password, status))
+        return candidates
+
+    def existing_usernames(self, usernames: list):
+        existing = set()
+        for i in range(0, len(usernames), self.chunk_size):
+            existing.update(name for name, in db.session.query(User.username)
+                .filter(User.username.in_(usernames[i:i + self.chunk_size])))
+        return existing
+
+    def import_batch(self, batch: list, pool):
+        candidates = self.validate(batch)
+        existing = self.existing_usernames([candidate[0] for candidate in candidates])
+        new_users = [candidate for candidate in candidates if candidate[0] not in existing]
+        self.counts["existing"] += len(candidates) - len(new_users)
+        if self.dry_run:
+            self.counts["imported"] += len(new_users)
+            return
+
+        # Hash what was not hashed beforehand, spread over the pool
+        passwords = [password for _, password_hash, password, _ in new_users if password_hash is None]
+        if pool is not None and passwords:
+            hashes = iter(pool.map(hash_password, passwords, chunksize=max(1, len(passwords) // (self.workers * 4))))
+        else:
+            hashes = iter([hash_password(password) for password in passwords])
+        users = [(username, password_hash if password_hash is not None else next(hashes), status)
+            for username, password_hash, _, status in new_users]
+
+        # Another process may create some of the users meanwhile, in which
+        # case the batch is retried without them
+        for attempt in range(2):
+            try:
+                self.insert_users(users)
+                db.session.commit()
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt:
+                    raise
+                existing = self.existing_usernames([user[0] for user in users])
+                self.counts["existing"] += len(existing)
+                users = [user for user in users if user[0] not in existing]
+        self.counts["imported"] += len(users)
+
+    def insert_users(self, users: list):
+        if not users:
+            return
+        now = datetime.utcnow().replace(microsecond=0)
+        usernames = [username for username, _, _ in users]
+        db.session.execute(insert(User.__table__), [{"username": username, "password": password_hash,
+            "last_updated": now, "follows_updated": now} for username, password_hash, _ in users])
+
+        ids = {}
+        for i in range(0, len(usernames), self.chunk_size):
+            chunk = usernames[i:i + self.chunk_size]
+            ids.update(db.session.query(User.username, User.id).filter(User.username.in_(chunk)))
+            # Keep the change log compacted, as UserChange.record does
+            db.session.execute(delete(UserChange.__table__).where(
+                UserChange.__table__.c.kind == 'status', UserChange.__table__.c.username.in_(chunk)))
+
+        db.session.execute(insert(UserStatus.__table__), [dict({field: None for field in STATUS_FIELDS},
+            user_id=ids[username], **status) for username, _, status in users])
+        db.session.execute(insert(UserAvatar.__table__), [{"user_id": ids[username]} for username in usernames])
+        db.session.execute(insert(UserChange.__table__), [{"username": username, "kind": 'status', "timestamp": now}
+            for username in usernames])
@@ -0,0 +1,279 @@
+from application import db
+from .process import ProcessStart
+from flask import request
+from sqlalchemy import event
+from bisect import bisect_left
+from contextlib import nullcontext
+from functools import lru_cache
+from threading import Lock, Thread, local
+from time import perf_counter, sleep
+from os import getpid, listdir, makedirs, path, remove, replace
+from uuid import uuid4
+import atexit
+import json
+
+# Totals of exited workers, kept by the gunicorn master in METRICS_DIR
+EXITED_FILE = "exited.json"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Name -> (type, help, histogram buckets)
+METRICS = {
+    'flashpaper_requests_total': ('counter', "Requests handled, by route, method and status", None),
+    'flashpaper_request_duration_seconds': ('histogram', "Time to produce a response, by route", LATENCY_BUCKETS),
+    'flashpaper_request_sql_statements': ('histogram', "SQL statements run per request, by route", STATEMENT_BUCKETS),
+    'flashpaper_request_sql_seconds': ('histogram', "Time spent in SQL per request, by route", LATENCY_BUCKETS),
+    'flashpaper_sql_statements_total': ('counter', "SQL statements run in and outside of requests", None),
+    'flashpaper_sql_seconds_total': ('counter', "Time spent in SQL in and outside of requests", None),
+    'flashpaper_helper_duration_seconds': ('histogram', "Time spent in expensive helpers", LATENCY_BUCKETS),
+    'flashpaper_status_cache_hits_total': ('counter', "Status cache lookups answered from the cache", None),
+    'flashpaper_status_cache_misses_total': ('counter', "Status cache lookups that went to the database", None),
+    'flashpaper_admission_admitted_total': ('counter', "Requests admitted by admission control", None),
+    'flashpaper_admission_rejected_total': ('counter', "Requests refused by admission control, by reason", None),
+}
+
+@lru_cache(maxsize=4096)
+def label_string(**labels):
+    # Prometheus label set, also used as the key for a series
+    return ",".join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+class Timer:
+    def __init__(self, metrics, helper: str):
+        self.metrics = metrics
+        self.labels = label_string(helper=helper)
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe('flashpaper_helper_duration_seconds', self.labels, perf_counter() - self.started)
+        return False
+
+class Metrics:
+    # Request, SQL and helper timings kept in memory by each worker. When
+    # METRICS_DIR is set every worker also writes its totals there, and a
+    # scrape served by any worker sums the files of all of them.
+    def __init__(self, app=None):
+        self.enabled = False
+        self.directory = None
+        self.lock = Lock()
+        self.counters = {}  # name -> {labels: value}
+        self.histograms = {}  # name -> {labels: [count per bucket..., count above, sum]}
+        self.state = local()
+        self.ensure_started = ProcessStart(self.start)
+        self.file_name = None
+        self.status_cache = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = bool(app.config['METRICS_ENABLED'])
+        self.directory = app.config['METRICS_DIR']
+        self.flush_interval = app.config['METRICS_FLUSH_INTERVAL']
+        if not self.enabled:
+            return
+        from application import status_cache
+        self.status_cache = status_cache
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", self.before_cursor_execute)
+            event.listen(db.engine, "after_cursor_execute", self.after_cursor_execute)
+
+    def start(self):
+        with self.lock:
+            # PIDs are reused, so each worker writes a file of its own
+            self.file_name = "{}-{}.json".format(getpid(), uuid4().hex)
+            self.counters.clear()
+            self.histograms.clear()
+        if self.directory:
+            Thread(target=self.run, name="metrics-writer", daemon=True).start()
+            atexit.register(self.write)
+
+    def timer(self, helper: str):
+        if not self.enabled:
+            return nullcontext()
+        return Timer(self, helper)
+
+    def increment(self, name: str, labels: str, value: float = 1):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name: str, labels: str, value: float):
+        buckets = METRICS[name][2]
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            counts = series.get(labels)
+            if counts is None:
+                counts = series[labels] = [0] * (len(buckets) + 2)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-1] += value
+
+    def before_request(self):
+        self.ensure_started()
+        state = self.state
+        state.active = True
+        state.statements = 0
+        state.sql_time = 0.0
+        state.started = perf_counter()
+
+    def after_request(self, response):
+        state = self.state
+        if not getattr(state, 'active', False):
+            return response
+        state.active = False
+        elapsed = perf_counter() - state.started
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        labels = label_string(route=route)
+        self.increment('flashpaper_requests_total',
+            label_string(route=route, method=request.method, status=response.status_code))
+        self.observe('flashpaper_request_duration_seconds', labels, elapsed)
+        self.observe('flashpaper_request_sql_statements', labels, state.statements)
+        self.observe('flashpaper_request_sql_seconds', labels, state.sql_time)
+        return response
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        self.state.sql_started = perf_counter()
+
+    def after_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        state = self.state
+        elapsed = perf_counter() - state.sql_started
+        if getattr(state, 'active', False):
+            state.statements += 1
+            state.sql_time += elapsed
+            labels = 'context="request"'
+        else:
+            labels = 'context="background"'
+        self.increment('flashpaper_sql_statements_total', labels)
+        self.increment('flashpaper_sql_seconds_total', labels, elapsed)
+
+    def snapshot(self):
+        with self.lock:
+            counters = {name: dict(series) for name, series in self.counters.items()}
+            histograms = {name: {labels: list(counts) for labels, counts in series.items()}
+                for name, series in self.histograms.items()}
+        stats = self.status_cache.stats()
+        counters['flashpaper_status_cache_hits_total'] = {"": stats["hits"]}
+        counters['flashpaper_status_cache_misses_total'] = {"": stats["misses"]}
+        return {"counters": counters, "histograms": histograms}
+
+    def run(self):
+        while True:
+            sleep(self.flush_interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def write(self):
+        write_file(path.join(self.directory, self.file_name), self.snapshot())
+
+    def collect(self):
+        # Totals of every worker that has written metrics, this one included,
+        # and of those that exited. Worker files are read before the totals
+        # of exited workers, which list the files folded into them, so a
+        # file folded meanwhile is counted exactly once.
+        if not self.directory:
+            return [self.snapshot()]
+        self.write()
+        snapshots = {}
+        for name in listdir(self.directory):
+            if name.endswith(".json") and name != EXITED_FILE:
+                snapshot = read_file(path.join(self.directory, name))
+                if snapshot is not None:
+                    snapshots[name] = snapshot
+        exited = read_file(path.join(self.directory, EXITED_FILE))
+        if exited is None:
+            return list(snapshots.values())
+        folded = set(exited["folded"])
+        return [exited] + [snapshot for name, snapshot in snapshots.items() if name not in folded]
+
+    def render(self):
+        self.ensure_started()
+        totals = empty_snapshot()
+        for snapshot in self.collect():
+            add_snapshot(totals, snapshot)
+        counters = totals["counters"]
+        histograms = totals["histograms"]
+
+        lines = []
+        for name, (kind, description, buckets) in METRICS.items():
+            lines.append("# HELP {} {}".format(name, description))
+            lines.append("# TYPE {} {}".format(name, kind))
+            if kind == 'counter':
+                for labels, value in sorted(counters.get(name, {}).items()):
+                    lines.append("{}{} {}".format(name, "{" + labels + "}" if labels else "", value))
+                continue
+            for labels, counts in sorted(histograms.get(name, {}).items()):
+                prefix = labels + "," if labels else ""
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), counts):
+                    cumulative += count
+                    le = "+Inf" if bound == float('inf') else repr(float(bound))
+                    lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, le, cumulative))
+                lines.append("{}_sum{} {}".format(name, "{" + labels + "}" if labels else "", counts[-1]))
+                lines.append("{}_count{} {}".format(name, "{" + labels + "}" if labels else "", cumulative))
+        return "\n".join(lines) + "\n"
+
+def empty_snapshot():
+    return {"counters": {}, "histograms": {}}
+
+def add_snapshot(totals: dict, snapshot: dict):
+    for name, series in snapshot["counters"].items():
+        sums = totals["counters"].setdefault(name, {})
+        for labels, value in series.items():
+            sums[labels] = sums.get(labels, 0) + value
+    for name, series in snapshot["histograms"].items():
+        sums = totals["histograms"].setdefault(name, {})
+        for labels, counts in series.items():
+            if labels in sums:
+                sums[labels] = [a + b for a, b in zip(sums[labels], counts)]
+            else:
+                sums[labels] = list(counts)
+
+def read_file(file_path: str):
+    try:
+        with open(file_path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def write_file(file_path: str, data: dict):
+    # Replace the file in one step so readers never see half of it
+    makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path + ".tmp", 'w') as file:
+        json.dump(data, file)
+    replace(file_path + ".tmp", file_path)
+
+def fold_exited(directory: str, pid: int = None):
+    # Add the files of exited workers, those of pid or else all of them, to
+    # the totals in EXITED_FILE and remove them, so counters never go back
+    # and the directory does not grow. Run by the gunicorn master alone.
+    if not path.isdir(directory):
+        return
+    exited_path = path.join(directory, EXITED_FILE)
+    totals = read_file(exited_path) or dict(empty_snapshot(), folded=[])
+    names = set(listdir(directory))
+    prefix = None if pid is None else "{}-".format(pid)
+    # Files folded before but left behind are only listed again
+    folded = [name for name in totals["folded"] if name in names]
+    for name in sorted(names):
+        if not name.endswith(".json") or name == EXITED_FILE or name in folded:
+            continue
+        if prefix is not None and not name.startswith(prefix):
+            continue
+        snapshot = read_file(path.join(directory, name))
+        if snapshot is not None:
+            add_snapshot(totals, snapshot)
+            folded.append(name)
+    totals["folded"] = folded
+    write_file(exited_path, totals)
+    for name in folded:
+        try:
+            remove(path.join(directory, name))
+        except FileNotFoundError:
+            pass
@@ -1,15 +1,15 @@
 from application import db
-from flask_inputs import Inputs
-from flask_inputs.validators import JsonSchema
+from sqlalchemy import delete, text
+from datetime import datetime
 
 class User(db.Model):
     __tablename__ = 'users'
 
     # Core User Data
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String)
+    username = db.Column(db.String, unique=True, index=True)
     password = db.Column(db.String)
-    last_updated = db.Column(db.DateTime)
+    last_updated = db.Column(db.DateTime, index=True)
 
     # User Configurables
     avatar = db.relationship('UserAvatar', uselist=False, backref='users', cascade='all, delete-orphan')
@@ -33,7 +33,7 @@ class User(db.Model):
 class UserStatus(db.Model):
     __tablename__ = 'userstatuses'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, index=True)
  
     # User Status Data  
     name = db.Column(db.String)
@@ -46,14 +46,29 @@ class UserStatus(db.Model):
 class UserAvatar(db.Model):
     __tablename__ = 'avatars'
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), unique=True, index=True)
 
     # User Avatar Data
     original = db.Column(db.String)
     original_key = db.Column(db.String)
+    sizes = db.Column(db.String)  # Comma separated variant resolutions
+    mime_type = db.Column(db.String)
+    byte_size = db.Column(db.Integer)
+    digest = db.Column(db.String)  # SHA-256 of the original, used as ETag
+    updated = db.Column(db.DateTime)  # Upload time, sent as Last-Modified
+    encodings = db.Column(db.String)  # Comma separated alternative formats, smallest first, see AvatarBlob
+
+class AvatarBlob(db.Model):
+    __tablename__ = 'avatarblobs'
+    # An avatar image stored once under its SHA-256, with its variants
+    digest = db.Column(db.String, primary_key=True)
+    refcount = db.Column(db.Integer)  # Avatars showing this image
+    sizes = db.Column(db.String)  # Comma separated variant resolutions
+    encodings = db.Column(db.String)  # Comma separated alternative formats, None until transcoded
 
 class UserFollow(db.Model):
     __tablename__ = 'follows'
+    __table_args__ = (db.Index('ix_follows_user_id_username', 'user_id', 'username', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
@@ -62,6 +77,7 @@ class UserFollow(db.Model):
 
 class UserWebhook(db.Model):
     __tablename__ = 'webhooks'
+    __table_args__ = (db.Index('ix_webhooks_user_id_url', 'user_id', 'url', unique=True),)
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
 
@@ -71,38 +87,37 @@ class UserWebhook(db.Model):
     latest_response = db.Column(db.Integer)
     latest_timestamp = db.Column(db.DateTime)
 
-class JsonLengthInputs(Inputs):
-    json = [JsonSchema(schema={
-        'type': 'object',
-        'properties': {
-            'name': {
-                'maxlength': 40,
-            }, 'status': {
-                'maxLength': 100,
-            }, 'media': {
-                'maxLength': 100,
-            }
-        },
-        'additionalProperties': True,
-    })]
-
-class JsonTypeInputs(Inputs):
-    json = [JsonSchema(schema={
-        'type': 'object',
-        'properties': {
-            'name': {
-                'type': 'string'
-            }, 'status': {
-                'type': 'string'
-            }, 'emoji': {
-                'type': 'string'
-            }, 'media': {
-                'type': 'string'
-            }, 'media_type': {
-                'type': 'integer'
-            }, 'uri': {
-                'type': 'string'
-            }
-        },
-        'additionalProperties': True,
-    })]
\ No newline at end of file
+class UserChange(db.Model):
+    __tablename__ = 'changes'
+    # AUTOINCREMENT keeps sequence numbers from being reused after compaction
+    __table_args__ = (db.Index('ix_changes_username_kind', 'username', 'kind'), {'sqlite_autoincrement': True})
+    seq = db.Column(db.Integer, primary_key=True)
+
+    # Change Data
+    username = db.Column(db.String)
+    kind = db.Column(db.String)
+    timestamp = db.Column(db.DateTime)
+
+    # Kinds of change affecting what others see of a user
+    STATUS_KINDS = ('status', 'avatar', 'deleted')
+
+    # Cursors are the highest committed seq, so changes must commit in seq
+    # order. SQLite has a single writer; PostgreSQL takes ORDER_LOCK from
+    # recording a change until commit. Other databases give no such order.
+    ORDERED_DIALECTS = ('sqlite', 'postgresql')
+    ORDER_LOCK = 0x666d726c  # Advisory lock key, "fmrl"
+
+    @staticmethod
+    def record(username: str, kind: str):
+        # Append to the change log in the current transaction, compacting
+        # away earlier changes of the same kind to the same user
+        if db.engine.dialect.name == 'postgresql':
+            db.session.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": UserChange.ORDER_LOCK})
+        change = UserChange(username=username, kind=kind, timestamp=datetime.utcnow())
+        db.session.add(change)
+        db.session.flush()
+        db.session.execute(delete(UserChange.__table__).where(
+            UserChange.__table__.c.username == username,
+            UserChange.__table__.c.kind == kind,
+            UserChange.__table__.c.seq < change.seq))
+        return change.seq
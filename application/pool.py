@@ -0,0 +1,140 @@
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+from ipaddress import ip_address
+from socket import IPPROTO_TCP, SOCK_STREAM, TCP_NODELAY, create_connection, getaddrinfo
+from socket import timeout as SocketTimeout
+from threading import Lock
+from urllib.parse import urlparse
+
+class AddressNotAllowed(OSError):
+    pass
+
+class AddressPolicy:
+    # Which addresses outbound requests may connect to. Only globally
+    # routable ones by default, so user supplied URLs cannot reach loopback,
+    # private or link-local services such as cloud metadata endpoints.
+    # allow and deny are lists of networks; trusted_hosts are exempt.
+    def __init__(self, allow: list = (), deny: list = (), trusted_hosts=()):
+        self.allow = list(allow)
+        self.deny = list(deny)
+        self.trusted_hosts = set(host.lower() for host in trusted_hosts)
+
+    def permits(self, address: str):
+        ip = ip_address(address.split("%", 1)[0])
+        if ip.version == 6 and ip.ipv4_mapped is not None:
+            ip = ip.ipv4_mapped
+        if any(ip in network for network in self.deny):
+            return False
+        if any(ip in network for network in self.allow):
+            return True
+        return ip.is_global
+
+    def permits_host(self, host: str):
+        # Early check of a URL's host without resolving it. Names other than
+        # localhost pass here and are checked when connecting.
+        host = host.lower()
+        if host in self.trusted_hosts:
+            return True
+        if host == "localhost" or host.endswith(".localhost"):
+            return False
+        try:
+            return self.permits(host)
+        except ValueError:
+            return True
+
+    def resolve(self, host: str, port: int):
+        # The address to connect to, checked once here and then pinned, so
+        # a second DNS answer cannot point the connection elsewhere
+        addresses = [info[4][0] for info in getaddrinfo(host, port, type=SOCK_STREAM)]
+        if host.lower() in self.trusted_hosts:
+            return addresses[0]
+        for address in addresses:
+            if self.permits(address):
+                return address
+        raise AddressNotAllowed("{} resolves to no permitted address".format(host))
+
+class PinnedHTTPConnection(HTTPConnection):
+    # Connects to an address resolved beforehand, still naming the host in
+    # the Host header and, over HTTPS, in SNI and certificate checks. Takes
+    # HTTPConnection's positional arguments, as HTTPSConnection passes them
+    # on through super().
+    def __init__(self, host: str, *args, address: str = None, **kwargs):
+        super().__init__(host, *args, **kwargs)
+        self.address = address
+
+    def connect(self):
+        self.sock = create_connection((self.address, self.port), self.timeout, self.source_address)
+        self.sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+
+class PinnedHTTPSConnection(HTTPSConnection, PinnedHTTPConnection):
+    # HTTPSConnection.connect() wraps the socket PinnedHTTPConnection opens
+    def __init__(self, host: str, address: str, **kwargs):
+        HTTPSConnection.__init__(self, host, **kwargs)
+        self.address = address
+
+class ConnectionPool:
+    # Keep-alive HTTP(S) connections shared between threads, kept per
+    # scheme and host so repeated requests to a server skip the handshake.
+    # With a policy, new connections go only to addresses it permits.
+    # context is the SSLContext for HTTPS, the system defaults if None.
+    def __init__(self, timeout: float = 5, max_idle: int = 8, policy: AddressPolicy = None, context=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.policy = policy
+        self.context = context
+        self.idle = {}
+        self.lock = Lock()
+
+    def acquire(self, scheme: str, netloc: str):
+        with self.lock:
+            connections = self.idle.get((scheme, netloc))
+            if connections:
+                return connections.pop(), True
+        if self.policy is None:
+            if scheme == "https":
+                return HTTPSConnection(netloc, timeout=self.timeout, context=self.context), False
+            return HTTPConnection(netloc, timeout=self.timeout), False
+        parsed = urlparse("//" + netloc)
+        if scheme == "https":
+            address = self.policy.resolve(parsed.hostname, parsed.port or 443)
+            return PinnedHTTPSConnection(netloc, address, timeout=self.timeout, context=self.context), False
+        address = self.policy.resolve(parsed.hostname, parsed.port or 80)
+        return PinnedHTTPConnection(netloc, address=address, timeout=self.timeout), False
+
+    def release(self, scheme: str, netloc: str, connection):
+        with self.lock:
+            connections = self.idle.setdefault((scheme, netloc), [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def request(self, method: str, url: str, body: bytes = None, headers: dict = None):
+        # Returns the response and its body. A pooled connection the server
+        # has since closed is retried once on a fresh connection.
+        parsed = urlparse(url)
+        target = parsed.path or "/"
+        if parsed.query:
+            target += "?" + parsed.query
+        while True:
+            connection, reused = self.acquire(parsed.scheme, parsed.netloc)
+            try:
+                connection.request(method, target, body=body, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+            except (OSError, HTTPException) as error:
+                connection.close()
+                if reused and not isinstance(error, SocketTimeout):
+                    continue
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(parsed.scheme, parsed.netloc, connection)
+            return response, data
+
+    def close(self):
+        with self.lock:
+            for connections in self.idle.values():
+                for connection in connections:
+                    connection.close()
+            self.idle.clear()
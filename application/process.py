@@ -0,0 +1,32 @@
+from os import register_at_fork
+from threading import RLock
+from weakref import WeakSet
+
+class ProcessStart:
+    # Runs a component's start function once per process, on first use.
+    # Threads, pools and connections do not survive a fork, so every
+    # instance is reset in a forked child, such as a gunicorn worker, and
+    # starts again there.
+    instances = WeakSet()
+
+    def __init__(self, start):
+        self.start = start
+        self.started = False
+        self.lock = RLock()
+        ProcessStart.instances.add(self)
+
+    def __call__(self):
+        if self.started:
+            return
+        with self.lock:
+            if not self.started:
+                self.start()
+                self.started = True
+
+def reset_after_fork():
+    # The parent's lock may have been held by a thread the child lacks
+    for instance in list(ProcessStart.instances):
+        instance.started = False
+        instance.lock = RLock()
+
+register_at_fork(after_in_child=reset_after_fork)
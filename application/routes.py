@@ -1,27 +1,32 @@
 # Application Imports
-from application import db, httpauth
-from .models import JsonLengthInputs, JsonTypeInputs, User, UserFollow, UserWebhook
+from application import avatar_transcoder, db, event_hub, federation_client, httpauth, metrics, status_cache, \
+    webhook_dispatcher
+from .cache import StatusEntry, status_entry
+from .avatars import ENCODING_TYPES, acquire_blob, avatar_etag, avatar_last_modified, closest_variant, discard_file, \
+    inspect_avatar, is_blob, parse_sizes, png_dimensions, preferred_encoding, purge_blob, release_blob, replace_avatar, \
+    send_avatar, spool_upload, stored_filename
+from .models import User, UserAvatar, UserChange, UserFollow, UserWebhook
+from .validation import validate_status_update
 from flask import current_app as app
-from rfc3986 import is_valid_uri, normalize_uri
+from sqlalchemy import delete, func, insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 import re
 
 # Main Imports
-from flask import Response, request, json, send_from_directory
+from flask import Response, request, json, stream_with_context
 from flask_cors import cross_origin
-from emoji_data import EmojiSequence
-
-# Avatar Imports
-from werkzeug.security import safe_join
-from PIL import Image
-from io import BytesIO
-import magic
-from os import path
 
 # Timestamp Imports
 from datetime import datetime
-from dateutil.parser import parse as parsedate
 from email.utils import formatdate
 from calendar import timegm
+from hashlib import blake2b
+
+# Batch Imports
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bisect import bisect_right
+from binascii import Error as Base64Error
 
 # Webhooks Imports
 from urllib.parse import urlparse
@@ -33,20 +38,80 @@ def is_valid_user(username: str):
         return None
     return user
 
-def is_authorized_user(request_username: str, auth_username: str):
-    user = is_valid_user(request_username)
-    if user is None or user.username != auth_username:
+def is_authorized_user(request_username: str, auth_user: User):
+    # verify_password already loaded the authenticated user, reuse it
+    if auth_user is None or auth_user.username != request_username:
         return None
-    return user
+    return auth_user
+
+def parse_http_date(value: str):
+    from dateutil.parser import parse as parsedate
+    return parsedate(value).replace(tzinfo=None)
 
 def is_modified(request_header: str, timestamp: datetime):
     if request_header is not None:
-        return parsedate(request_header).replace(tzinfo=None) < timestamp
+        return parse_http_date(request_header) < timestamp
     return True
 
+def lookup_users(usernames):
+    # Fetch users with their status and avatar in as few queries as possible.
+    # Large batches are split so the IN clause stays below SQLite's bound
+    # parameter limit.
+    usernames = list(usernames)
+    chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+    users = {}
+    for i in range(0, len(usernames), chunk_size):
+        query = User.query.options(joinedload(User.avatar), joinedload(User.status_data)) \
+            .filter(User.username.in_(usernames[i:i + chunk_size]))
+        for user in query:
+            users.setdefault(user.username, user)
+    return users
+
+def get_status_entries(usernames):
+    # Resolve serialized statuses through the status cache, loading only the
+    # users whose cached entry is missing or older than the database row.
+    if status_cache.max_size <= 0:
+        return {username: build_status_entry(user) for username, user in lookup_users(usernames).items()}
+
+    usernames = list(usernames)
+    chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+    now = datetime.utcnow().replace(microsecond=0)
+    entries = {}
+    stale = set()
+    for i in range(0, len(usernames), chunk_size):
+        query = db.session.query(User.username, User.last_updated) \
+            .filter(User.username.in_(usernames[i:i + chunk_size]))
+        for username, last_updated in query:
+            if username in entries or username in stale:
+                continue
+            entry = status_cache.get(username, last_updated)
+            if entry is None:
+                stale.add(username)
+            else:
+                entries[username] = entry
+
+    for username, user in lookup_users(stale).items():
+        entries[username] = build_status_entry(user)
+        # Timestamps only have second resolution, so a row written during the
+        # current second could change again without its timestamp moving.
+        if user.last_updated < now:
+            status_cache.put(username, entries[username])
+    return entries
+
+def build_status_entry(user: User):
+    with metrics.timer('json_encode'):
+        data = json.dumps(get_user_status_data(user)).encode('utf-8')
+    return status_entry(
+        data=data,
+        last_updated=user.last_updated,
+        last_modified=http_date(user.last_updated))
+
+def http_date(timestamp: datetime):
+    return formatdate(timeval=timegm(timestamp.timetuple()), localtime=False, usegmt=True)
+
 def unmodified_response(timestamp: datetime):
     response = Response(None, status=304)
-    response.headers['Last-Modified'] = formatdate(timeval=timegm(timestamp.timetuple()), localtime=False, usegmt=True)
+    response.headers['Last-Modified'] = http_date(timestamp)
     return response
 
 def invalid_request_response(error: str = "Invalid Request", code: int = 400):
@@ -70,152 +135,335 @@ def is_valid_username(username: str):
 @app.route('/.well-known/fmrl/user/<username>/avatar', methods=['PUT'])
 @httpauth.login_required
 def update_user_avatar(username: str):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    # Imaging libraries are loaded on first upload, see preload_modules()
+    from PIL import Image
+    import magic
+
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
         
+    # Refuse uploads declaring an oversized body before reading anything
+    if request.content_length is not None and request.content_length > app.config['UPLOAD_MAX_SIZE']:
+        return Response("File too large.", status=413)
+
+    # Hand the database connection back while the body is read from a
+    # possibly slow client; the user is reloaded when next accessed
+    db.session.rollback()
+
     # Grab first chunk for MIME analysis
-    file_size = 0
-    chunk_size = 4096
-    first_chunk = True
-    image_bytes = BytesIO()
-    chunk = request.stream.read(chunk_size)
-    file_type = magic.from_buffer(chunk, mime=True)
+    chunk = request.stream.read(app.config['UPLOAD_CHUNK_SIZE'])
+    with metrics.timer('magic'):
+        file_type = magic.from_buffer(chunk, mime=True)
 
     # Validate file magic
     if file_type not in app.config['ALLOWED_UPLOAD_TYPES']:
         return invalid_request_response("Image not recognized as JPEG or PNG")
 
-    # Read image into buffer and validate file size.
-    while True:
-        if first_chunk:
-            image_bytes.write(chunk)
-            first_chunk = False
-        else:
-            file_size += len(chunk)
-            if file_size > app.config['UPLOAD_MAX_SIZE']:
-                return Response("File too large.", status=413)
-            chunk = request.stream.read(chunk_size)
-            if len(chunk) == 0:
-                break
-            image_bytes.write(chunk)
-    
-    img = Image.open(image_bytes)
-    if img.height != img.width:
-        return invalid_request_response("Image must be square")
-    
-    # Stream buffer back to file on disk
-    # TODO - Beef up security here
-    with open(safe_join(app.config['AVATARS_DIR'], user.username), "bw") as file:
-        file.write(image_bytes.getbuffer())
-
-    # Update user and timestamp, return success
-    user.avatar.original = "/.well-known/fmrl/avatars/{}".format(user.username)
-    user.avatar.original_key = update_user_timestamp(user)
+    # PNGs are decoded in full to render variants, unlike JPEGs, so their
+    # size is checked from the header before the rest is read
+    dimensions = png_dimensions(chunk) if file_type == 'image/png' else None
+    if dimensions is not None and dimensions[0] * dimensions[1] > app.config['AVATAR_MAX_DECODED_PIXELS']:
+        return invalid_request_response("Image dimensions too large")
+
+    # Spool image to a temporary file, validating file size on every chunk
+    upload = spool_upload(request.stream, chunk)
+    if upload is None:
+        return Response("File too large.", status=413)
+
+    try:
+        # The same image again changes nothing, so cached URLs stay valid
+        if is_blob(user.avatar) and user.avatar.digest == upload.digest:
+            return Response("Success.", status=200)
+
+        # Opening only parses the header, pixels are decoded for the variants
+        try:
+            with metrics.timer('image_open'):
+                img = Image.open(upload.path)
+        except (OSError, Image.DecompressionBombError):
+            return invalid_request_response("Image not recognized as JPEG or PNG")
+        with img:
+            if img.height != img.width:
+                return invalid_request_response("Image must be square")
+            if img.width > app.config['AVATAR_MAX_DIMENSION']:
+                return invalid_request_response("Image dimensions too large")
+            try:
+                with metrics.timer('image_variants'):
+                    sizes, encodings, created = acquire_blob(upload, img)
+            except Image.DecompressionBombError:
+                db.session.rollback()
+                return invalid_request_response("Image dimensions too large")
+            except OSError:
+                db.session.rollback()
+                return invalid_request_response("Image could not be decoded")
+    finally:
+        discard_file(upload.path)
+
+    # Point the user at the new image, dropping the old one if unused. A
+    # concurrent upload may have replaced the avatar since it was read.
+    updated = datetime.utcnow().replace(microsecond=0)
+    remove_files = replace_avatar(user.avatar.id, username, {
+        "original": "/.well-known/fmrl/avatars/{}".format(username),
+        "sizes": ",".join(str(size) for size in sizes),
+        "mime_type": file_type,
+        "byte_size": upload.byte_size,
+        "digest": upload.digest,
+        "original_key": upload.digest,
+        "updated": updated,
+        "encodings": encodings,
+    })
+    if remove_files is None:
+        # The user was deleted meanwhile
+        release_blob(upload.digest)
+        db.session.commit()
+        purge_blob(upload.digest)
+        return missinguser_response()
+    user.last_updated = updated
+    seq = UserChange.record(username, 'avatar')
     db.session.commit()
+    remove_files()
+    # Smaller encodings are made once the new image is stored
+    if created:
+        avatar_transcoder.submit(upload.digest)
+    # The commit expired the user, the route's username saves reloading it
+    status_cache.invalidate(username)
+    webhook_dispatcher.notify(username)
+    event_hub.publish(username, seq)
     return Response("Success.", status=200)
 
 @app.route('/.well-known/fmrl/user/<username>', methods=['PATCH'])
 @httpauth.login_required
 def update_user_status(username: str):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
     
-    # Schema Validation
-    if not JsonLengthInputs(request).validate():
-        return Response("Update field(s) too long!", status=413)
-    if not JsonTypeInputs(request).validate():
-        return invalid_request_response("Update fields not a valid type")
-    
-    # Semantic Validation
-    update = {} 
-    if request.json.get('avatar') is not None:
-        return invalid_request_response("Invalid endpoint for updating avatar")
-    
-    if request.json.get('emoji') is not None:
-        if not request.json['emoji'] in EmojiSequence and request.json['emoji']:
-            return invalid_request_response("Invalid emoji")
-        update['emoji'] = request.json['emoji']
-
-    regex = re.compile('[\u0000-\u001F\u007F\u0080-\u009F]')
-    for field in {"status", "media", "name"}:
-        if request.json.get(field) is not None:
-            if regex.search(request.json.get(field)) is not None:
-                return invalid_request_response("Invalid unicode character(s)")
-            update[field] = request.json[field]
-    
-    if request.json.get('media_type') is not None:
-        update['media_type'] = request.json['media_type']
-
-    if request.json.get('uri') is not None:
-        if not is_valid_uri(request.json['uri']) or len(request.json['uri'].encode('utf-8')) > 500:
-            return invalid_request_response("Invalid URI")
-        update['uri'] = normalize_uri(request.json['uri'])
+    update, error = validate_status_update(request.json)
+    if error is not None:
+        code, message = error
+        return invalid_request_response(message, code)
 
     # Validation passed. Update user and times
     if update:
         for field in update:
             setattr(user.status_data, field, update[field])
         update_user_timestamp(user)
+        seq = UserChange.record(user.username, 'status')
         db.session.commit()
+        status_cache.invalidate(username)
+        webhook_dispatcher.notify(username)
+        event_hub.publish(username, seq)
     return Response("Success.", status=200)
 
 @cross_origin()
-@app.route('/.well-known/fmrl/users', methods=['GET'])
+@app.route('/.well-known/fmrl/users', methods=['GET', 'POST'])
 def get_user_statuses():
+    # Batches too long for a URL may be POSTed as a form with the same fields
+    if request.method == 'POST':
+        if request.mimetype != 'application/x-www-form-urlencoded':
+            return invalid_request_response("Expected a form body")
+        if request.content_length is None or request.content_length > app.config['BATCH_MAX_BODY_SIZE']:
+            return Response("Request too large.", status=413)
+        params = request.form
+    else:
+        params = request.args
+
     # Basic request validation
-    if not request.args.getlist('user'):
+    if not params.getlist('user'):
         return invalid_request_response()
 
     # If requested, send only updates newer than specified
     query_time = None
     if request.headers.get('If-Modified-Since') is not None:
-        query_time = parsedate(request.headers['If-Modified-Since']).replace(tzinfo=None)
+        query_time = parse_http_date(request.headers['If-Modified-Since'])
     
-    users_list = []
-    latest = None
-
-    for username in set(request.args.getlist('user')):
-        query = get_user_status(username, query_time)
-        if query.headers.get('Last_modified') is not None:
-            timestamp = parsedate(query.headers.get('Last-Modified')).replace(tzinfo=None)
-            if latest is None or latest < timestamp:
-                latest = timestamp
-        
-        if query.status_code == 200:
-            # User exists. Return data normally.
-            users_list.append({"username": username, "code": query.status_code, "data": query.get_json()})
+    # Large requests are answered a page at a time, each page resuming after
+    # the last username of the one before
+    usernames = sorted(set(params.getlist('user')))
+    if params.get('continue') is not None:
+        after = parse_continuation_token(params['continue'])
+        if after is None:
+            return invalid_request_response("Invalid continuation token")
+        usernames = usernames[bisect_right(usernames, after):]
+    next_token = None
+    if len(usernames) > app.config['BATCH_MAX_USERS']:
+        usernames = usernames[:app.config['BATCH_MAX_USERS']]
+        next_token = continuation_token(usernames[-1])
+
+    if len(usernames) >= app.config['BATCH_STREAM_MIN_USERS']:
+        response = stream_batch(usernames, query_time)
+    else:
+        response = batch_response(usernames, query_time)
+    if next_token is not None:
+        response.headers['X-Continuation-Token'] = next_token
+    return response
 
-        elif query.status_code == 304:
-            # No change since last-modified. Return simple.
-            users_list.append({"username": username, "code": query.status_code})
+def batch_response(usernames: list, query_time=None):
+    entries = get_status_entries(usernames)
 
-        else:
-            # User doesn't exist or some other issue. Return fault.
-            users_list.append({"username": username, "code": query.status_code, "msg": query.get_data(as_text=True)})
-    return Response(json.dumps(users_list), status=200, mimetype='application/json')
+    # The whole batch is validated by the versions of the requested users
+    etag = batch_etag(usernames, entries, request.headers.get('If-Modified-Since'))
+    if request.method == 'GET' and request.if_none_match.contains_weak(etag):
+        response = Response(None, status=304)
+    else:
+        users_list = [render_batch_entry(username, entries.get(username), query_time) for username in usernames]
+        response = Response(b'[' + b', '.join(users_list) + b']', status=200, mimetype='application/json')
+    response.set_etag(etag, weak=True)
+    if entries:
+        response.last_modified = max(entry.last_updated for entry in entries.values())
+    return response
 
-def get_user_status(username: str, query_time=None):
-    user = is_valid_user(username=username)
-    if user is None:
-        return missinguser_response()
-    # If requested, send only updates newer than specified
-    if query_time is not None and query_time >= user.last_updated:
-        return unmodified_response(user.last_updated)
-    
+def stream_batch(usernames: list, query_time=None):
+    # Look users up LOOKUP_CHUNK_SIZE at a time and send every chunk as soon
+    # as it is rendered, so memory stays flat and the first bytes leave at
+    # once. Without the whole batch at hand there is no ETag.
+    chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+
+    def chunks():
+        yield b'['
+        for i in range(0, len(usernames), chunk_size):
+            chunk = usernames[i:i + chunk_size]
+            entries = get_status_entries(chunk)
+            # Hand the database connection back while the client reads
+            db.session.rollback()
+            users_list = [render_batch_entry(username, entries.get(username), query_time) for username in chunk]
+            yield (b', ' if i else b'') + b', '.join(users_list)
+        yield b']'
+
+    return Response(stream_with_context(chunks()), status=200, mimetype='application/json')
+
+def continuation_token(username: str):
+    return urlsafe_b64encode(username.encode('utf-8')).decode('ascii').rstrip("=")
+
+def parse_continuation_token(token: str):
+    try:
+        return urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode('utf-8')
+    except (Base64Error, UnicodeDecodeError, ValueError):
+        return None
+
+def batch_etag(usernames: list, entries: dict, *variants):
+    digest = blake2b(digest_size=16)
+    for variant in variants:
+        digest.update("{}\0".format(variant).encode('utf-8'))
+    for username in usernames:
+        entry = entries.get(username)
+        digest.update("{}\0{}\0".format(username, entry.etag if entry else "-").encode('utf-8'))
+    return digest.hexdigest()
+
+@app.route('/.well-known/fmrl/users/changes', methods=['GET'])
+@cross_origin()
+def get_user_changes():
+    # Delta sync: statuses of the requested users changed after the client's
+    # cursor, along with the cursor to send next time
+    if db.engine.dialect.name not in UserChange.ORDERED_DIALECTS:
+        return Response("Delta sync needs SQLite or PostgreSQL.", status=501)
+    usernames = list(set(request.args.getlist('user')))
+    if not usernames:
+        return invalid_request_response()
+    try:
+        since = int(request.args.get('since', 0))
+    except ValueError:
+        return invalid_request_response("Invalid cursor")
+
+    # Changes committed while this runs are left for the next poll
+    cursor = db.session.query(func.max(UserChange.seq)).scalar() or 0
+    chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+    changed = set()
+    for i in range(0, len(usernames), chunk_size):
+        query = db.session.query(UserChange.username).filter(
+            UserChange.seq > since, UserChange.seq <= cursor,
+            UserChange.kind.in_(UserChange.STATUS_KINDS),
+            UserChange.username.in_(usernames[i:i + chunk_size]))
+        changed.update(username for username, in query)
+
+    entries = get_status_entries(changed)
+    users_list = [render_batch_entry(username, entries.get(username)) for username in sorted(changed)]
+    body = b''.join((b'{"cursor": ', str(cursor).encode('utf-8'), b', "users": [', b', '.join(users_list), b']}'))
+    return Response(body, status=200, mimetype='application/json')
+
+@app.route('/.well-known/fmrl/users/stream', methods=['GET'])
+@cross_origin()
+def stream_user_statuses():
+    # Server-sent events: the current status of every requested user, then
+    # each user again whenever their status or avatar changes
+    usernames = set(request.args.getlist('user'))
+    if not usernames:
+        return invalid_request_response()
+    if len(usernames) > app.config['EVENTS_MAX_USERS']:
+        return invalid_request_response("Too many users requested")
+
+    subscription = event_hub.subscribe(usernames)
+    if subscription is None:
+        response = Response("Too many subscribers", status=503)
+        response.headers['Retry-After'] = str(app.config['EVENTS_HEARTBEAT'])
+        return response
+
+    flask_app = app._get_current_object()
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+
+    def events():
+        try:
+            changed = usernames
+            while True:
+                if changed:
+                    # A fresh app context per batch gives a fresh session
+                    with flask_app.app_context():
+                        entries = get_status_entries(changed)
+                    for username in changed:
+                        yield b'event: status\ndata: ' + render_batch_entry(username, entries.get(username)) + b'\n\n'
+                else:
+                    yield b': keepalive\n\n'
+                changed = subscription.wait(heartbeat)
+        finally:
+            event_hub.unsubscribe(subscription)
+
+    response = Response(events(), status=200, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+def render_batch_entry(username: str, entry, query_time=None):
+    # Entries are a StatusEntry, None for unknown users, or a (code, message)
+    # tuple for users that could not be looked up
+    if entry is None:
+        # User doesn't exist. Return fault.
+        entry = (404, "No such user")
+    if not isinstance(entry, StatusEntry):
+        return json.dumps({"username": username, "code": entry[0], "msg": entry[1]}).encode('utf-8')
+
+    if query_time is not None and query_time >= entry.last_updated:
+        # No change since last-modified. Return simple.
+        return json.dumps({"username": username, "code": 304}).encode('utf-8')
+
+    # User exists. Splice the cached payload in without re-encoding it.
+    return b''.join((
+        b'{"code": 200, "data": ', entry.data,
+        b', "username": ', json.dumps(username).encode('utf-8'), b'}'))
+
+def get_user_status_data(user: User):
     # Empty responses are valid, should return only values which are set
     user_status = {}
     if user.avatar.original is not None:
         user_status['avatar'] = {"original": "{}?{}".format(user.avatar.original, user.avatar.original_key)}
+        for size in parse_sizes(user.avatar.sizes):
+            user_status['avatar'][str(size)] = "{}?{}&size={}".format(user.avatar.original, user.avatar.original_key, size)
     for field in {"name", "status", "emoji", "media", "media_type", "uri"}:
         e = getattr(user.status_data, field)
         if e is not None:
             user_status[field] = e
+    return user_status
+
+def get_user_status(username: str, query_time=None):
+    entry = get_status_entries([username]).get(username)
+    if entry is None:
+        return missinguser_response()
+    # If requested, send only updates newer than specified
+    if query_time is not None and query_time >= entry.last_updated:
+        return unmodified_response(entry.last_updated)
 
     # Return successful response and user data
-    response = Response(json.dumps(user_status), status=200, mimetype='application/json')
-    response.headers['Last-Modified'] = formatdate(timeval=timegm(user.last_updated.timetuple()), localtime=False, usegmt=True)
+    response = Response(entry.data, status=200, mimetype='application/json')
+    response.headers['Last-Modified'] = entry.last_modified
     return response
 
 ### fmrl following routes
@@ -223,73 +471,167 @@ def get_user_status(username: str, query_time=None):
 @app.route('/.well-known/fmrl/user/<username>/following', methods=['GET'])
 @httpauth.login_required
 def get_user_following(username):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
 
     if not is_modified(request.headers.get('If-Modified-Since'), user.follows_updated):
         return unmodified_response(user.follows_updated)
 
-    user_follows = []
-    if user.follows is not None:
-        for follow in user.follows:
-            user_follows.append(follow.username)
+    user_follows = [name for name, in db.session.query(UserFollow.username).filter_by(user_id=user.id)]
 
     # Return successful response and user data
     response = Response(json.dumps(user_follows), status=200, mimetype='application/json')
-    response.headers['Last-Modified'] = formatdate(timeval=timegm(user.follows_updated.timetuple()), localtime=False, usegmt=True)
+    response.headers['Last-Modified'] = http_date(user.follows_updated)
+    return response
+
+@app.route('/.well-known/fmrl/user/<username>/following/statuses', methods=['GET'])
+@httpauth.login_required
+def get_user_following_statuses(username):
+    user = is_authorized_user(username, httpauth.current_user())
+    if user is None:
+        return unauthorized_response()
+
+    # If requested, send only updates newer than specified
+    query_time = None
+    if request.headers.get('If-Modified-Since') is not None:
+        query_time = parse_http_date(request.headers['If-Modified-Since'])
+
+    # Accounts on this server are read directly, the rest fetched per host
+    local_domain = (app.config['SERVER_DOMAIN'] or request.host.split(':')[0]).lower()
+    local = {}
+    remote = []
+    for address, in db.session.query(UserFollow.username).filter_by(user_id=user.id):
+        name, host = address[1:].split('@')
+        if host.lower() == local_domain:
+            local[address] = name
+        else:
+            remote.append(address)
+
+    entries = federation_client.fetch(remote)
+    local_entries = get_status_entries(local.values())
+    for address, name in local.items():
+        entries[address] = local_entries.get(name)
+
+    users_list = [render_batch_entry(address, entries.get(address), query_time) for address in sorted(entries)]
+    response = Response(b'[' + b', '.join(users_list) + b']', status=200, mimetype='application/json')
+    # The newest status in the feed, for the client's next If-Modified-Since
+    updated = [entry.last_updated for entry in entries.values() if isinstance(entry, StatusEntry)]
+    if updated:
+        response.headers['Last-Modified'] = http_date(max(updated))
     return response
 
 @app.route('/.well-known/fmrl/user/<username>/following', methods=['PATCH'])
 @httpauth.login_required
 def set_user_following(username: str):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
     
-    success = False
-    for action in {"add", "remove"}:
+    # Validate the whole batch before touching the database
+    changes = {"add": set(), "remove": set()}
+    for action in changes:
         if type(request.json.get(action)) is list:
             for name in request.json[action]:
-                if not is_valid_username(name):
+                if type(name) is not str or not is_valid_username(name):
                     return invalid_request_response("Invalid username(s)")
-                if action == "add":
-                    success = True
-                    if user.follows.filter_by(username=name).first() is None:
-                        user.follows.append(UserFollow(username=name))
-                else:
-                    success = True
-                    follow = user.follows.filter_by(username=name).first()
-                    if follow is not None:
-                        user.follows.remove(follow)
-    if success:
-        user.follows_updated = datetime.utcnow().replace(microsecond=0)
-        db.session.commit()
-        return Response(None, status=200)
-    else:
+                changes[action].add(name)
+    if not changes["add"] and not changes["remove"]:
         return invalid_request_response()
 
+    # Apply the difference against the current follow set in bulk. A
+    # concurrent request adding the same account trips the unique index, in
+    # which case the diff is recomputed once.
+    for attempt in range(2):
+        try:
+            apply_follow_changes(user.id, changes["add"], changes["remove"])
+            user.follows_updated = datetime.utcnow().replace(microsecond=0)
+            UserChange.record(user.username, 'follows')
+            db.session.commit()
+            return Response(None, status=200)
+        except IntegrityError:
+            db.session.rollback()
+            if attempt:
+                raise
+
+def apply_follow_changes(user_id: int, add: set, remove: set):
+    current = {name for name, in db.session.query(UserFollow.username).filter_by(user_id=user_id)}
+    additions = add - remove - current
+    removals = list(remove & current)
+    if additions:
+        db.session.execute(insert(UserFollow.__table__), [{"user_id": user_id, "username": name} for name in additions])
+    chunk_size = app.config['LOOKUP_CHUNK_SIZE']
+    for i in range(0, len(removals), chunk_size):
+        db.session.execute(delete(UserFollow.__table__).where(
+            UserFollow.__table__.c.user_id == user_id, UserFollow.__table__.c.username.in_(removals[i:i + chunk_size])))
+
 ### flashpaper routes
 
-# TODO - Implement multiple resolution support
 @cross_origin()
 @app.route('/.well-known/fmrl/avatars/<username>', methods=['GET'])
 def get_user_avatar(username: str):
-    user = is_valid_user(username=username)
-    if user is None:
+    # Metadata recorded at upload is enough to answer without opening the file
+    avatar = UserAvatar.query.join(User, UserAvatar.user_id == User.id).filter(User.username == username).first()
+    if avatar is None:
         return missinguser_response()
-    image_path = safe_join(app.config['AVATARS_DIR'], username)
-    if path.exists(image_path):
-        mime_type = magic.from_file(image_path, mime=True)
-        with open(image_path, "r") as image:
-            return send_from_directory(app.config['AVATARS_DIR'], username, mimetype=mime_type)
-    else:
+    if avatar.original is None:
         return Response("No such image found.", status=404)
 
+    # Serve the smallest variant covering the requested resolution
+    size = None
+    if request.args.get('size') is not None:
+        try:
+            requested = int(request.args['size'])
+        except ValueError:
+            return invalid_request_response("Invalid avatar size")
+        if requested <= 0:
+            return invalid_request_response("Invalid avatar size")
+        size = closest_variant(parse_sizes(avatar.sizes), requested)
+
+    if avatar.digest is None:
+        if not inspect_avatar(avatar, username):
+            return Response("No such image found.", status=404)
+        db.session.commit()
+    # Blob URLs carry the digest, so the image behind one never changes once
+    # its encodings are made
+    immutable = is_blob(avatar) and avatar.digest in request.args and avatar.encodings is not None
+
+    # Send the smallest encoding the client accepts
+    encoding = preferred_encoding(avatar, request.accept_mimetypes)
+    mime_type = ENCODING_TYPES[encoding] if encoding is not None else avatar.mime_type
+
+    etag = avatar_etag(avatar, size, encoding)
+    last_modified = avatar_last_modified(avatar)
+    if request.if_none_match:
+        unmodified = request.if_none_match.contains(etag)
+    else:
+        unmodified = request.if_modified_since is not None and \
+            request.if_modified_since.replace(tzinfo=None) >= last_modified
+    if unmodified:
+        response = Response(None, status=304)
+    else:
+        response = send_avatar(stored_filename(avatar, username, size, encoding), mime_type, etag, last_modified)
+        if response.status_code == 404:
+            return response
+    # Blobs left without other encodings are the same whatever is accepted
+    if is_blob(avatar) and avatar.encodings != "":
+        response.vary.add('Accept')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.public = True
+    if immutable:
+        response.cache_control.max_age = app.config['AVATAR_IMMUTABLE_MAX_AGE']
+        response.cache_control.immutable = True
+        # Set from AVATAR_MAX_AGE when the file was sent
+        del response.headers['Expires']
+    else:
+        response.cache_control.max_age = app.config['AVATAR_MAX_AGE']
+    return response
+
 @app.route('/.well-known/fmrl/user/<username>/webhooks', methods=['POST'])
 @httpauth.login_required
 def add_user_webhook(username):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
 
@@ -307,6 +649,8 @@ def add_user_webhook(username):
             return invalid_request_response("Webhooks must not contain credentials")
         if parsed_url.params or parsed_url.query or parsed_url.fragment:
             return invalid_request_response("Webhooks must not contain a parameter, querystring, or fragment")
+        if not parsed_url.hostname or not webhook_dispatcher.policy.permits_host(parsed_url.hostname):
+            return invalid_request_response("Webhooks must point at a public address")
     
     if request.json.get('method') is not None:
         if request.json['method'].upper() not in {"GET", "POST"}:
@@ -323,7 +667,7 @@ def add_user_webhook(username):
 @app.route('/.well-known/fmrl/user/<username>/webhooks/<webhook_id>', methods=['DELETE'])
 @httpauth.login_required
 def delete_user_webhook(username, webhook_id):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
 
@@ -346,7 +690,7 @@ def delete_user_webhook(username, webhook_id):
 @app.route('/.well-known/fmrl/user/<username>/webhooks', methods=['GET'])
 @httpauth.login_required
 def get_user_webhooks(username):
-    user = is_authorized_user(username, httpauth.current_user().username)
+    user = is_authorized_user(username, httpauth.current_user())
     if user is None:
         return unauthorized_response()
     
@@ -356,10 +700,21 @@ def get_user_webhooks(username):
     user_webhooks = []
     if user.webhooks is not None:
         for webhook in user.webhooks:
-            user_webhooks.append({"id": webhook.id, "url": webhook.url, "method": webhook.method})
+            user_webhooks.append({
+                "id": webhook.id, "url": webhook.url, "method": webhook.method,
+                "latest_response": webhook.latest_response,
+                "latest_timestamp": http_date(webhook.latest_timestamp) if webhook.latest_timestamp else None})
     
     return Response(json.dumps(user_webhooks), status=200, mimetype='application/json')
 
+### metrics
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if not metrics.enabled:
+        return Response("Metrics are disabled", status=404)
+    return Response(metrics.render(), status=200, mimetype='text/plain; version=0.0.4')
+
 ### invalid routes
 
 @app.route('/.well-known/fmrl/', defaults={'path': ''})
@@ -0,0 +1,82 @@
+from application import db
+from .models import User, UserChange
+from sqlalchemy import create_engine, exists, insert, inspect, literal, select, text
+from os import environ
+
+def create_schema(engine):
+    # Create missing tables, then bring existing ones up to date
+    db.metadata.create_all(bind=engine)
+    upgrade_schema(engine)
+
+def upgrade_database():
+    # One-time schema step before serving, run by the gunicorn master with
+    # an engine of its own so no connection is inherited by the workers.
+    # Development databases live in memory and are created by the app.
+    if environ.get('FLASK_ENV') != "production":
+        return
+    from config import ProductionConfig
+    engine = create_engine(ProductionConfig.SQLALCHEMY_DATABASE_URI)
+    try:
+        create_schema(engine)
+    finally:
+        engine.dispose()
+
+def upgrade_schema(engine):
+    # create_all() only creates missing tables. Bring existing databases up
+    # to date with columns and indexes added since they were created; new
+    # columns are all nullable.
+    preparer = engine.dialect.identifier_preparer
+    analyze = False
+    with engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                    preparer.quote(table.name), preparer.quote(column.name),
+                    column.type.compile(dialect=engine.dialect))))
+
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing:
+                    continue
+                if index.unique:
+                    remove_duplicates(connection, table, [column.name for column in index.columns])
+                index.create(bind=connection)
+                analyze = True
+
+        backfill_changes(connection)
+
+        # Refresh planner statistics so the new indexes get used
+        if analyze:
+            connection.execute(text("ANALYZE"))
+
+def backfill_changes(connection):
+    # Users created before the change log have no entry in it, so a delta
+    # sync from the start would never return them. Every user since has a
+    # status change, kept through compaction; record one for those without.
+    users = User.__table__
+    changes = UserChange.__table__
+    missing = select(users.c.username, literal('status'), users.c.last_updated).where(~exists().where(
+        changes.c.username == users.c.username, changes.c.kind == 'status'))
+    result = connection.execute(insert(changes).from_select(['username', 'kind', 'timestamp'], missing))
+    if result.rowcount:
+        print("Added {} existing user(s) to the change log.".format(result.rowcount))
+
+def remove_duplicates(connection, table, columns: list):
+    # Older databases were not protected against duplicate rows. Keep the
+    # oldest row of each group so a unique index can be created, unless
+    # other tables refer to the rows and they need resolving by hand.
+    preparer = connection.dialect.identifier_preparer
+    if any(key.column.table is table for other in db.metadata.sorted_tables for key in other.foreign_keys):
+        return
+    quoted = ", ".join(preparer.quote(column) for column in columns)
+    result = connection.execute(text(
+        "DELETE FROM {table} WHERE id NOT IN (SELECT MIN(id) FROM {table} GROUP BY {columns})".format(
+            table=preparer.quote(table.name), columns=quoted)))
+    if result.rowcount:
+        print("Removed {} duplicate row(s) from {}.".format(result.rowcount, table.name))
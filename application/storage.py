@@ -0,0 +1,16 @@
+from application import db
+from sqlalchemy import event
+
+def configure_storage(app):
+    # Tune every new SQLite connection with SQLITE_PRAGMAS. WAL journaling
+    # lets readers in other workers carry on while one of them writes.
+    if db.engine.dialect.name != "sqlite":
+        return
+    pragmas = app.config['SQLITE_PRAGMAS']
+
+    @event.listens_for(db.engine, "connect")
+    def apply_pragmas(connection, record):
+        cursor = connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute("PRAGMA {}={}".format(name, value))
+        cursor.close()
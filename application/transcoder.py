@@ -0,0 +1,146 @@
+from application import db
+from .models import AvatarBlob, UserAvatar
+from .process import ProcessStart
+from sqlalchemy import update
+from concurrent.futures import ThreadPoolExecutor
+from os import path, replace
+
+class AvatarTranscoder:
+    # Writes smaller encodings of every stored avatar, in the formats of
+    # AVATAR_ENCODINGS that Pillow can write, on a thread pool after upload.
+    # Until a blob has been transcoded its avatars are served as uploaded,
+    # and encodings no smaller than the upload are not kept.
+    def __init__(self, app=None):
+        self.app = None
+        self.encodings = None
+        self.ensure_started = ProcessStart(self.start)
+        self.executor = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.options = app.config['AVATAR_ENCODINGS']
+        self.workers = app.config['AVATAR_TRANSCODE_WORKERS']
+        self.max_pixels = app.config['AVATAR_MAX_DECODED_PIXELS']
+        self.async_mode = app.config['ASYNC_MODE']
+        self.encodings = None
+
+    def available(self):
+        # Formats this Pillow can write, checked on first use since imaging
+        # libraries are loaded lazily
+        if self.encodings is None:
+            from PIL import Image
+            try:
+                import pillow_avif  # Registers AVIF with Pillow releases lacking it
+            except ImportError:
+                pass
+            Image.init()
+            self.encodings = [encoding for encoding in self.options if encoding.upper() in Image.SAVE]
+        return self.encodings
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="transcoder")
+
+    def submit(self, digest: str):
+        if not self.available():
+            return
+        self.ensure_started()
+        self.executor.submit(self.run, digest)
+
+    def offload(self, function, *args):
+        # Decoding and encoding hold the CPU. With gevent the pool's threads
+        # are greenlets, so this work goes to a native thread of gevent's own
+        # pool while the event loop serves other connections.
+        if self.async_mode:
+            from gevent import get_hub
+            return get_hub().threadpool.apply(function, args)
+        return function(*args)
+
+    def run(self, digest: str):
+        try:
+            with self.app.app_context():
+                self.transcode(digest)
+        except Exception:
+            self.app.logger.exception("Transcoding avatar %s failed", digest)
+
+    def transcode(self, digest: str):
+        from PIL import Image
+        from .avatars import blob_path, discard_file, parse_sizes
+        sizes = db.session.query(AvatarBlob.sizes).filter(AvatarBlob.digest == digest, AvatarBlob.refcount > 0).scalar()
+        if sizes is None:
+            return
+        original_size = path.getsize(blob_path(digest))
+
+        # Encode the original and every variant, keeping the formats that
+        # come out smaller than the upload, smallest first
+        sources = [(size, blob_path(digest, size)) for size in [None] + parse_sizes(sizes)]
+        try:
+            encoded = self.offload(encode_images, sources, self.available(), self.options,
+                self.app.config['AVATARS_DIR'], self.max_pixels)
+        except Image.DecompressionBombError:
+            # Stored before AVATAR_MAX_DECODED_PIXELS, so served as uploaded
+            encoded = {}
+        try:
+            byte_sizes = {encoding: path.getsize(files[0][1]) for encoding, files in encoded.items()}
+            kept = sorted((encoding for encoding in encoded if byte_sizes[encoding] < original_size), key=byte_sizes.get)
+            installed = []
+            for encoding in kept:
+                for size, file_path in encoded[encoding]:
+                    replace(file_path, blob_path(digest, size, encoding))
+                    installed.append(blob_path(digest, size, encoding))
+        finally:
+            for files in encoded.values():
+                for _, file_path in files:
+                    discard_file(file_path)
+
+        # Record the encodings on the blob and the avatars showing it. Should
+        # no avatar show the blob any more, the new files go as well.
+        blobs = AvatarBlob.__table__
+        avatars = UserAvatar.__table__
+        value = ",".join(kept)
+        if db.session.execute(update(blobs).where(blobs.c.digest == digest, blobs.c.refcount > 0)
+                .values(encodings=value)).rowcount:
+            db.session.execute(update(avatars).where(avatars.c.digest == digest, avatars.c.original_key == digest)
+                .values(encodings=value))
+        else:
+            for file_path in installed:
+                discard_file(file_path)
+        db.session.commit()
+
+def encode_images(sources: list, encodings: list, options: dict, directory: str, max_pixels: int):
+    # Encode every (size, file) of sources in each encoding, decoding each
+    # once, to temporary files in directory. Returns encoding -> [(size,
+    # temporary file)]. Uses no application state, so it runs on any thread.
+    from PIL import Image
+    from .avatars import discard_file, draft_within, temporary_file
+    encoded = {encoding: [] for encoding in encodings}
+    try:
+        for size, source_path in sources:
+            with Image.open(source_path) as source:
+                # A large JPEG original is encoded from a reduced scale
+                if not draft_within(source, max_pixels):
+                    raise Image.DecompressionBombError("{} is too large to decode".format(source_path))
+                img = strip_image(source)
+            for encoding in encodings:
+                with temporary_file(directory) as file:
+                    encoded[encoding].append((size, file.name))
+                    img.save(file, format=encoding.upper(), icc_profile=img.info.get("icc_profile"), **options[encoding])
+    except BaseException:
+        for files in encoded.values():
+            for _, file_path in files:
+                discard_file(file_path)
+        raise
+    return encoded
+
+def strip_image(img):
+    # A copy in a mode every encoder takes, without EXIF, XMP or other
+    # metadata. The colour profile stays when it describes RGB, as the
+    # pixels are still in its colour space.
+    alpha = img.mode in ("RGBA", "LA", "PA") or (img.mode == "P" and "transparency" in img.info)
+    icc_profile = img.info.get("icc_profile")
+    img = img.convert("RGBA" if alpha else "RGB")
+    img.info = {}
+    if icc_profile and icc_profile[16:20] == b"RGB ":
+        img.info["icc_profile"] = icc_profile
+    return img
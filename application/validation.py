@@ -0,0 +1,87 @@
+import re
+
+# Control characters (C0, DEL and C1) are not allowed in free text fields
+CONTROL_CHARACTERS = re.compile('[\u0000-\u001F\u007F\u0080-\u009F]')
+
+URI_MAX_BYTES = 500
+
+# Errors in the order they take precedence when a payload has several
+TOO_LONG, INVALID_TYPE, AVATAR_FIELD, INVALID_EMOJI, INVALID_CHARACTERS, INVALID_URI = range(6)
+ERRORS = {
+    TOO_LONG: (413, "Update field(s) too long!"),
+    INVALID_TYPE: (400, "Update fields not a valid type"),
+    AVATAR_FIELD: (400, "Invalid endpoint for updating avatar"),
+    INVALID_EMOJI: (400, "Invalid emoji"),
+    INVALID_CHARACTERS: (400, "Invalid unicode character(s)"),
+    INVALID_URI: (400, "Invalid URI"),
+}
+
+def check_text(value):
+    if CONTROL_CHARACTERS.search(value) is not None:
+        return INVALID_CHARACTERS
+    return None
+
+# emoji_data takes over a second to import, so it and rfc3986 are loaded
+# on first use, or up front by application.preload_modules()
+
+def check_emoji(value):
+    from emoji_data import EmojiSequence
+    if value and value not in EmojiSequence:
+        return INVALID_EMOJI
+    return None
+
+def check_uri(value):
+    from rfc3986 import is_valid_uri
+    if len(value.encode('utf-8')) > URI_MAX_BYTES or not is_valid_uri(value):
+        return INVALID_URI
+    return None
+
+def normalize_uri(value):
+    from rfc3986 import normalize_uri
+    return normalize_uri(value)
+
+def is_integer(value):
+    # JSON numbers such as 1.0 are integers too
+    if isinstance(value, bool):
+        return False
+    return isinstance(value, int) or (isinstance(value, float) and value.is_integer())
+
+def is_string(value):
+    return isinstance(value, str)
+
+# Field name -> (type check, max length in characters, value check, normalizer)
+STATUS_FIELDS = {
+    'name': (is_string, 40, check_text, None),
+    'status': (is_string, 100, check_text, None),
+    'emoji': (is_string, None, check_emoji, None),
+    'media': (is_string, 100, check_text, None),
+    'media_type': (is_integer, None, None, None),
+    'uri': (is_string, None, check_uri, normalize_uri),
+}
+
+def validate_status_update(payload):
+    # Validates an fmrl status PATCH body in a single pass over its fields.
+    # Returns the fields to update and None, or None and a (code, message)
+    # tuple for the highest-precedence error found.
+    if not isinstance(payload, dict):
+        return None, ERRORS[TOO_LONG]
+    error = AVATAR_FIELD if payload.get('avatar') is not None else None
+    update = {}
+    for field, (type_check, max_length, value_check, normalize) in STATUS_FIELDS.items():
+        if field not in payload:
+            continue
+        value = payload[field]
+        if not type_check(value):
+            error = INVALID_TYPE
+            continue
+        if max_length is not None and len(value) > max_length:
+            return None, ERRORS[TOO_LONG]
+        if value_check is not None:
+            value_error = value_check(value)
+            if value_error is not None:
+                error = value_error if error is None else min(error, value_error)
+                continue
+        update[field] = normalize(value) if normalize is not None else value
+    if error is not None:
+        return None, ERRORS[error]
+    return update, None
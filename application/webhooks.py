@@ -0,0 +1,170 @@
+from application import db
+from .models import User, UserWebhook
+from .pool import AddressNotAllowed, AddressPolicy, ConnectionPool
+from .process import ProcessStart
+from sqlalchemy import bindparam, update
+from concurrent.futures import ThreadPoolExecutor
+from collections import namedtuple
+from datetime import datetime
+from http.client import HTTPException
+from itertools import count
+from threading import Condition, Thread
+from time import monotonic
+import atexit
+import heapq
+
+# A single webhook call; attempt counts retries already made
+Delivery = namedtuple('Delivery', ['webhook_id', 'url', 'method', 'body', 'attempt'])
+
+class WebhookDispatcher:
+    # Delivers user webhooks from background threads. Requests only record
+    # which users changed; updates arriving within WEBHOOK_COALESCE_DELAY of
+    # each other are sent as a single delivery carrying the latest status.
+    def __init__(self, app=None):
+        self.app = None
+        self.enabled = False
+        self.condition = Condition()
+        self.queue = []  # Heap of (due, sequence, username or Delivery)
+        self.sequence = count()
+        self.scheduled = set()
+        self.in_flight = set()
+        self.results = {}
+        self.ensure_started = ProcessStart(self.start)
+        self.executor = None
+        self.pool = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = bool(app.config['WEBHOOKS_ENABLED'])
+        self.workers = app.config['WEBHOOK_WORKERS']
+        self.timeout = app.config['WEBHOOK_TIMEOUT']
+        self.retries = app.config['WEBHOOK_RETRIES']
+        self.backoff = app.config['WEBHOOK_BACKOFF']
+        self.delay = app.config['WEBHOOK_COALESCE_DELAY']
+        self.flush_interval = app.config['WEBHOOK_FLUSH_INTERVAL']
+        self.policy = AddressPolicy(app.config['OUTBOUND_ALLOW'], app.config['OUTBOUND_DENY'])
+
+    def notify(self, username: str):
+        if not self.enabled:
+            return
+        with self.condition:
+            self.ensure_started()
+            if username in self.scheduled:
+                return
+            self.scheduled.add(username)
+            self.push(monotonic() + self.delay, username)
+
+    def start(self):
+        self.queue.clear()
+        self.scheduled.clear()
+        self.in_flight.clear()
+        self.results.clear()
+        self.pool = ConnectionPool(timeout=self.timeout, max_idle=self.workers, policy=self.policy)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="webhook")
+        Thread(target=self.run, name="webhook-dispatcher", daemon=True).start()
+        atexit.register(self.flush)
+
+    def push(self, due: float, item):
+        heapq.heappush(self.queue, (due, next(self.sequence), item))
+        self.condition.notify()
+
+    def run(self):
+        next_flush = monotonic() + self.flush_interval
+        while True:
+            users = []
+            deliveries = []
+            with self.condition:
+                while not self.queue or self.queue[0][0] > monotonic():
+                    wait_until = min(next_flush, self.queue[0][0]) if self.queue else next_flush
+                    if wait_until <= monotonic():
+                        break
+                    self.condition.wait(wait_until - monotonic())
+                while self.queue and self.queue[0][0] <= monotonic():
+                    item = heapq.heappop(self.queue)[2]
+                    if isinstance(item, Delivery):
+                        deliveries.append(item)
+                    else:
+                        self.scheduled.discard(item)
+                        users.append(item)
+            try:
+                if users:
+                    deliveries.extend(self.resolve(users))
+                for delivery in deliveries:
+                    self.submit(delivery)
+                if monotonic() >= next_flush:
+                    self.flush()
+                    next_flush = monotonic() + self.flush_interval
+            except Exception:
+                self.app.logger.exception("Webhook dispatch failed")
+
+    def resolve(self, usernames: list):
+        # Look up the webhooks and current status of every changed user at once
+        from .routes import get_status_entries, render_batch_entry
+        deliveries = []
+        with self.app.app_context():
+            entries = get_status_entries(usernames)
+            chunk_size = self.app.config['LOOKUP_CHUNK_SIZE']
+            for i in range(0, len(usernames), chunk_size):
+                query = db.session.query(User.username, UserWebhook.id, UserWebhook.url, UserWebhook.method) \
+                    .join(UserWebhook, UserWebhook.user_id == User.id) \
+                    .filter(User.username.in_(usernames[i:i + chunk_size]))
+                for username, webhook_id, url, method in query:
+                    entry = entries.get(username)
+                    if entry is None:
+                        continue
+                    body = render_batch_entry(username, entry) if method == "POST" else None
+                    deliveries.append(Delivery(webhook_id, url, method, body, 0))
+        return deliveries
+
+    def submit(self, delivery: Delivery):
+        with self.condition:
+            # Keep deliveries to one webhook in order by waiting for the last
+            if delivery.webhook_id in self.in_flight:
+                self.push(monotonic() + self.delay, delivery)
+                return
+            self.in_flight.add(delivery.webhook_id)
+        self.executor.submit(self.deliver, delivery)
+
+    def deliver(self, delivery: Delivery):
+        headers = {"User-Agent": "flashpaper"}
+        if delivery.body is not None:
+            headers["Content-Type"] = "application/json"
+        status = None
+        retry = True
+        try:
+            response, _ = self.pool.request(delivery.method, delivery.url, body=delivery.body, headers=headers)
+            status = response.status
+        except AddressNotAllowed:
+            # Refused by OUTBOUND_ALLOW and OUTBOUND_DENY, which retrying does not change
+            retry = False
+        except (OSError, HTTPException, ValueError):
+            pass
+        except Exception:
+            self.app.logger.exception("Webhook delivery to %s failed", delivery.url)
+            retry = False
+        finally:
+            # Always let the next delivery to this webhook go ahead
+            with self.condition:
+                self.in_flight.discard(delivery.webhook_id)
+                if retry and (status is None or status == 429 or status >= 500) and delivery.attempt < self.retries:
+                    retry_at = monotonic() + self.backoff * 2 ** delivery.attempt
+                    self.push(retry_at, delivery._replace(attempt=delivery.attempt + 1))
+                else:
+                    # A status of 0 records that the endpoint could not be reached
+                    self.results[delivery.webhook_id] = (status or 0, datetime.utcnow().replace(microsecond=0))
+
+    def flush(self):
+        # Record delivery results in one batched UPDATE
+        with self.condition:
+            results, self.results = self.results, {}
+        if not results:
+            return
+        with self.app.app_context():
+            db.session.execute(
+                update(UserWebhook.__table__).where(UserWebhook.__table__.c.id == bindparam('webhook_id'))
+                    .values(latest_response=bindparam('response'), latest_timestamp=bindparam('timestamp')),
+                [{"webhook_id": webhook_id, "response": response, "timestamp": timestamp}
+                    for webhook_id, (response, timestamp) in results.items()])
+            db.session.commit()
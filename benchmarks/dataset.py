@@ -0,0 +1,155 @@
+# Builds a synthetic flashpaper deployment to benchmark against: a SQLite
+# database of users with statuses, follows and webhooks, plus an avatars
+# directory, all under one output directory. Every user's password is
+# PASSWORD.
+#
+#   python -m benchmarks.dataset --out /tmp/flashpaper-bench --users 10000
+from argparse import ArgumentParser
+from datetime import datetime, timedelta
+from os import environ, makedirs, path
+import base64
+import io
+import random
+import shutil
+
+PASSWORD = "benchmark"
+LOCAL_DOMAIN = "bench.example"
+REMOTE_DOMAIN = "remote.example"
+
+WORDS = ("coffee", "reading", "walking", "the", "dog", "working", "on", "a", "new", "song",
+    "at", "home", "travelling", "café", "back", "soon", "lunch", "meeting", "garden", "music")
+EMOJI = ("\U0001F600", "\U0001F33B", "☕", "\U0001F3B5", "\U0001F4DA", "")
+
+def username(index: int):
+    return "user{:06d}".format(index)
+
+def basic_auth(name: str, password: str = PASSWORD):
+    credentials = "{}:{}".format(name, password).encode('utf-8')
+    return "Basic " + base64.b64encode(credentials).decode('ascii')
+
+def database_path(out: str):
+    return path.join(out, 'flashpaper.db')
+
+def create_app(out: str, connect_args: dict = None):
+    # Point the production config at the dataset before it is first imported.
+    # connect_args are passed on to sqlite3.connect, e.g. a connection factory.
+    environ['FLASK_ENV'] = 'production'
+    environ['FLASHPAPER_DATABASE_URL'] = "sqlite:///{}".format(database_path(path.abspath(out)))
+    environ['FLASHPAPER_AVATARS_DIR'] = path.join(path.abspath(out), 'avatars')
+    if connect_args:
+        from config import ProductionConfig
+        options = dict(ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS)
+        options['connect_args'] = dict(options.get('connect_args', {}), **connect_args)
+        ProductionConfig.SQLALCHEMY_ENGINE_OPTIONS = options
+    from application import init_app
+    return init_app()
+
+def copy_dataset(out: str, destination: str):
+    # Benchmarks that write work on a copy so runs start from the same state
+    shutil.copytree(out, destination)
+    return destination
+
+def avatar_image(rng: random.Random, dimension: int = 512):
+    from PIL import Image
+    # Seeded noise, scaled up so it compresses about as well as a photo
+    tile = dimension // 4
+    noise = Image.frombytes('RGB', (tile, tile), rng.randbytes(tile * tile * 3))
+    img = noise.resize((dimension, dimension), Image.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, 'PNG')
+    return buffer.getvalue()
+
+def status_row(rng: random.Random, user_id: int):
+    row = {"user_id": user_id, "name": username(user_id - 1).capitalize(),
+        "status": " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))),
+        "emoji": rng.choice(EMOJI), "media": None, "media_type": None, "uri": None}
+    if rng.random() < 0.3:
+        row["media"] = " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 5)))
+        row["media_type"] = rng.randint(0, 3)
+    if rng.random() < 0.2:
+        row["uri"] = "https://{}/{}".format(LOCAL_DOMAIN, username(user_id - 1))
+    return row
+
+def insert_rows(table, rows: list, chunk_size: int = 5000):
+    from application import db
+    for i in range(0, len(rows), chunk_size):
+        db.session.execute(table.insert(), rows[i:i + chunk_size])
+
+def generate(app, users: int, follows: int, webhooks: int, avatars: int, remote: float, seed: int):
+    from application import db
+    from application.models import User, UserAvatar, UserChange, UserFollow, UserStatus, UserWebhook
+    from application.schema import create_schema
+    from werkzeug.security import generate_password_hash
+    rng = random.Random(seed)
+    now = datetime.utcnow().replace(microsecond=0)
+    password = generate_password_hash(PASSWORD, method='sha256')
+
+    with app.app_context():
+        create_schema(db.engine)
+        user_rows = []
+        for user_id in range(1, users + 1):
+            updated = now - timedelta(seconds=rng.randint(60, 30 * 86400))
+            user_rows.append({"id": user_id, "username": username(user_id - 1), "password": password,
+                "last_updated": updated, "follows_updated": updated})
+        insert_rows(User.__table__, user_rows)
+        insert_rows(UserStatus.__table__, [status_row(rng, user_id) for user_id in range(1, users + 1)])
+        insert_rows(UserAvatar.__table__, [{"user_id": user_id} for user_id in range(1, users + 1)])
+        insert_rows(UserChange.__table__, [{"username": row["username"], "kind": "status", "timestamp": row["last_updated"]}
+            for row in sorted(user_rows, key=lambda row: row["last_updated"])])
+
+        follow_rows = []
+        for user_id in range(1, users + 1):
+            followed = set()
+            for _ in range(min(follows, users - 1)):
+                if rng.random() < remote:
+                    followed.add("@{}@{}".format(username(rng.randrange(users * 10)), REMOTE_DOMAIN))
+                else:
+                    followed.add("@{}@{}".format(username(rng.randrange(users)), LOCAL_DOMAIN))
+            follow_rows.extend({"user_id": user_id, "username": name} for name in followed)
+        insert_rows(UserFollow.__table__, follow_rows)
+
+        webhook_rows = []
+        for user_id in rng.sample(range(1, users + 1), min(webhooks, users)):
+            webhook_rows.append({"user_id": user_id, "url": "http://127.0.0.1:9/{}".format(username(user_id - 1)),
+                "method": rng.choice(("GET", "POST"))})
+        insert_rows(UserWebhook.__table__, webhook_rows)
+        db.session.commit()
+
+    # Avatars go through the upload endpoint so files and metadata match
+    client = app.test_client()
+    for user_id in rng.sample(range(1, users + 1), min(avatars, users)):
+        name = username(user_id - 1)
+        response = client.put('/.well-known/fmrl/user/{}/avatar'.format(name), data=avatar_image(rng),
+            headers={"Authorization": basic_auth(name)})
+        if response.status_code != 200:
+            raise RuntimeError("Avatar upload for {} failed: {}".format(name, response.status_code))
+
+    # Closing the connections checkpoints the WAL into the database file
+    with app.app_context():
+        db.engine.dispose()
+    return len(user_rows), len(follow_rows), len(webhook_rows)
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--out', required=True, help="Directory to create the dataset in")
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=50, help="Accounts followed per user")
+    parser.add_argument('--webhooks', type=int, default=1000, help="Users with a webhook")
+    parser.add_argument('--avatars', type=int, default=200, help="Users with an avatar")
+    parser.add_argument('--remote', type=float, default=0.2, help="Fraction of follows on other servers")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--force', action='store_true', help="Replace an existing dataset")
+    args = parser.parse_args()
+
+    if path.exists(args.out):
+        if not args.force:
+            parser.error("{} already exists, pass --force to replace it".format(args.out))
+        shutil.rmtree(args.out)
+    makedirs(path.join(args.out, 'avatars'))
+    app = create_app(args.out)
+    users, follows, webhooks = generate(app, args.users, args.follows, args.webhooks, args.avatars, args.remote, args.seed)
+    print("Created {} users, {} follows, {} webhooks and {} avatars in {}".format(
+        users, follows, webhooks, min(args.avatars, users), args.out))
+
+if __name__ == "__main__":
+    main()
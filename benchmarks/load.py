@@ -0,0 +1,166 @@
+# Multi-process HTTP load against gunicorn, started with the arguments of
+# the Dockerfile entry point on a scratch copy of a generated dataset.
+#
+#   python -m benchmarks.load --data /tmp/flashpaper-bench [--clients 8]
+#       [--duration SECONDS] [--workers N] [--mode threaded|async]
+#       [--streams N] [--save FILE] [--baseline FILE]
+from .dataset import basic_auth, copy_dataset, database_path, username
+from . import report
+from argparse import ArgumentParser
+from http.client import HTTPConnection, HTTPException
+from multiprocessing import Pool
+from tempfile import TemporaryDirectory
+from time import monotonic, perf_counter, sleep
+from os import environ, path
+import json
+import random
+import socket
+import sqlite3
+import subprocess
+import sys
+
+repo_dir = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Request mix as (name, weight)
+SCENARIOS = (("statuses[1]", 30), ("statuses[25]", 40), ("avatar", 20), ("status_patch", 10))
+
+def entrypoint(bind: str, workers: int = None):
+    # The gunicorn command line from the Dockerfile, bound to a local port
+    with open(path.join(repo_dir, 'Dockerfile')) as file:
+        line = next(line for line in file if line.startswith('ENTRYPOINT'))
+    command = json.loads(line[len('ENTRYPOINT'):])
+    command[command.index('--bind') + 1] = bind
+    if workers is not None:
+        command[1:1] = ['--workers', str(workers)]
+    return [sys.executable, '-m'] + command
+
+def wait_until_ready(host: str, port: int, server, timeout: float = 30):
+    deadline = monotonic() + timeout
+    while monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("gunicorn exited with status {}".format(server.returncode))
+        try:
+            connection = HTTPConnection(host, port, timeout=1)
+            connection.request('GET', '/.well-known/fmrl/users?user={}'.format(username(0)))
+            if connection.getresponse().status == 200:
+                return
+        except (OSError, HTTPException):
+            pass
+        sleep(0.2)
+    raise RuntimeError("gunicorn did not start within {} seconds".format(timeout))
+
+def open_streams(host: str, port: int, count: int, users: int):
+    # Idle event stream connections held open for the whole run, as slow
+    # or long-polling clients would
+    streams = []
+    for i in range(count):
+        stream = socket.create_connection((host, port), timeout=30)
+        stream.sendall("GET /.well-known/fmrl/users/stream?user={} HTTP/1.1\r\nHost: {}\r\n\r\n".format(
+            username(i % users), host).encode('ascii'))
+        streams.append(stream)
+    return streams
+
+def client(options: dict):
+    # One load generating process; returns latencies and error counts by scenario
+    rng = random.Random(options["seed"])
+    names = [name for name, _ in SCENARIOS]
+    weights = [weight for _, weight in SCENARIOS]
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    connection = HTTPConnection(options["host"], options["port"], timeout=30)
+    deadline = monotonic() + options["duration"]
+
+    while monotonic() < deadline:
+        scenario = rng.choices(names, weights)[0]
+        user = username(rng.randrange(options["users"]))
+        headers = {}
+        body = None
+        if scenario.startswith("statuses"):
+            size = int(scenario[len("statuses["):-1])
+            method = 'GET'
+            target = '/.well-known/fmrl/users?' + "&".join(
+                "user={}".format(username(rng.randrange(options["users"]))) for _ in range(size))
+        elif scenario == "avatar" and options["avatars"]:
+            method = 'GET'
+            target = '/.well-known/fmrl/avatars/{}?size=128'.format(rng.choice(options["avatars"]))
+        else:
+            scenario = "status_patch"
+            method = 'PATCH'
+            target = '/.well-known/fmrl/user/{}'.format(user)
+            body = json.dumps({"status": "load {}".format(rng.random())})
+            headers = {"Authorization": basic_auth(user), "Content-Type": "application/json"}
+
+        before = perf_counter()
+        try:
+            connection.request(method, target, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+        except (OSError, HTTPException):
+            connection.close()
+            connection = HTTPConnection(options["host"], options["port"], timeout=30)
+            ok = False
+        latencies[scenario].append(perf_counter() - before)
+        errors[scenario] += not ok
+    connection.close()
+    return latencies, errors
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--data', required=True, help="Dataset created by benchmarks.dataset")
+    parser.add_argument('--clients', type=int, default=8, help="Load generating processes")
+    parser.add_argument('--duration', type=float, default=30.0, help="Seconds of load")
+    parser.add_argument('--workers', type=int, help="gunicorn worker processes (default as in the Dockerfile)")
+    parser.add_argument('--mode', choices=('threaded', 'async'), default='threaded', help="FLASHPAPER_SERVER_MODE")
+    parser.add_argument('--streams', type=int, default=0, help="Idle event streams to hold open during the run")
+    parser.add_argument('--port', type=int, default=5080)
+    parser.add_argument('--seed', type=int, default=0)
+    report.add_arguments(parser)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as scratch:
+        data = copy_dataset(args.data, path.join(scratch, 'data'))
+        with sqlite3.connect(database_path(data)) as connection:
+            users = connection.execute("SELECT count(*) FROM users").fetchone()[0]
+            avatars = [name for name, in connection.execute("SELECT username FROM users JOIN avatars "
+                "ON avatars.user_id = users.id WHERE avatars.original IS NOT NULL ORDER BY username")]
+
+        env = dict(environ, FLASK_ENV='production',
+            FLASHPAPER_DATABASE_URL="sqlite:///{}".format(database_path(data)),
+            FLASHPAPER_AVATARS_DIR=path.join(data, 'avatars'), FLASHPAPER_SERVER_MODE=args.mode,
+            FLASHPAPER_EVENTS_MAX_SUBSCRIBERS=str(max(1000, args.streams)))
+        server = subprocess.Popen(entrypoint("127.0.0.1:{}".format(args.port), args.workers),
+            cwd=repo_dir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        streams = []
+        try:
+            wait_until_ready("127.0.0.1", args.port, server)
+            streams = open_streams("127.0.0.1", args.port, args.streams, users)
+            options = [{"host": "127.0.0.1", "port": args.port, "duration": args.duration, "users": users,
+                "avatars": avatars, "seed": args.seed + i} for i in range(args.clients)]
+            started = perf_counter()
+            with Pool(args.clients) as pool:
+                outcomes = pool.map(client, options)
+            elapsed = perf_counter() - started
+        finally:
+            for stream in streams:
+                stream.close()
+            server.terminate()
+            server.wait()
+
+    results = []
+    everything = []
+    total_errors = 0
+    for name, _ in SCENARIOS:
+        latencies = [latency for outcome in outcomes for latency in outcome[0][name]]
+        errors = sum(outcome[1][name] for outcome in outcomes)
+        everything.extend(latencies)
+        total_errors += errors
+        results.append(report.summarize(name, latencies, elapsed, errors))
+    results.append(report.summarize("all", everything, elapsed, total_errors))
+
+    settings = {"data": path.abspath(args.data), "users": users, "clients": args.clients, "duration": args.duration,
+        "workers": args.workers, "mode": args.mode, "streams": args.streams, "seed": args.seed}
+    raise SystemExit(report.report(results, args, settings))
+
+if __name__ == "__main__":
+    main()
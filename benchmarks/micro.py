@@ -0,0 +1,118 @@
+# In-process microbenchmarks of the request handlers, run through the Flask
+# test client against a scratch copy of a generated dataset.
+#
+#   python -m benchmarks.micro --data /tmp/flashpaper-bench [--only NAME ...]
+#       [--duration SECONDS] [--save FILE] [--baseline FILE]
+from .dataset import LOCAL_DOMAIN, avatar_image, basic_auth, copy_dataset, create_app, username
+from . import report
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from os import path
+import random
+
+BATCH_SIZES = (1, 10, 100, 1000)
+
+def benchmarks(app, users: int, rng: random.Random):
+    # Yields (name, call) pairs; each call makes one request and returns
+    # whether it got the expected response
+    from application import credential_cache
+    from application.auth import verify_password
+    from application.routes import get_user_status
+    client = app.test_client()
+
+    def random_user():
+        return username(rng.randrange(users))
+
+    def user_status():
+        with app.test_request_context():
+            return get_user_status(random_user()).status_code == 200
+    yield "get_user_status", user_status
+
+    for size in BATCH_SIZES:
+        def user_statuses(size=min(size, users)):
+            query = "&".join("user={}".format(name) for name in (random_user() for _ in range(size)))
+            return client.get('/.well-known/fmrl/users?' + query).status_code == 200
+        yield "get_user_statuses[{}]".format(size), user_statuses
+
+    def password(cached: bool):
+        def call():
+            if not cached:
+                credential_cache.clear()
+            with app.app_context():
+                return verify_password(random_user(), "benchmark") is not False
+        return call
+    yield "verify_password", password(cached=False)
+    yield "verify_password[cached]", password(cached=True)
+
+    from application import db
+    from application.models import User, UserAvatar
+    with app.app_context():
+        with_avatars = [name for name, in db.session.query(User.username).join(UserAvatar, UserAvatar.user_id == User.id)
+            .filter(UserAvatar.original.isnot(None)).order_by(User.username)]
+    if with_avatars:
+        def avatar_serve():
+            name = rng.choice(with_avatars)
+            return client.get('/.well-known/fmrl/avatars/{}?size=128'.format(name)).status_code == 200
+        yield "avatar_serve", avatar_serve
+
+    image = avatar_image(rng)
+    def avatar_upload():
+        name = random_user()
+        return client.put('/.well-known/fmrl/user/{}/avatar'.format(name), data=image,
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "avatar_upload", avatar_upload
+
+    def follow_patch():
+        name = random_user()
+        followed = ["@{}@{}".format(random_user(), LOCAL_DOMAIN) for _ in range(2)]
+        return client.patch('/.well-known/fmrl/user/{}/following'.format(name),
+            json={"add": followed[:1], "remove": followed[1:]},
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "follow_patch", follow_patch
+
+def run(call, duration: float, minimum: int, warmup: int):
+    for _ in range(warmup):
+        call()
+    latencies = []
+    errors = 0
+    started = perf_counter()
+    while len(latencies) < minimum or perf_counter() - started < duration:
+        before = perf_counter()
+        ok = call()
+        latencies.append(perf_counter() - before)
+        errors += not ok
+    return latencies, perf_counter() - started, errors
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--data', required=True, help="Dataset created by benchmarks.dataset")
+    parser.add_argument('--only', action='append', help="Run only the named benchmark(s)")
+    parser.add_argument('--duration', type=float, default=3.0, help="Seconds per benchmark")
+    parser.add_argument('--minimum', type=int, default=20, help="Fewest calls per benchmark")
+    parser.add_argument('--warmup', type=int, default=10, help="Untimed calls before each benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    report.add_arguments(parser)
+    args = parser.parse_args()
+
+    with TemporaryDirectory() as scratch:
+        app = create_app(copy_dataset(args.data, path.join(scratch, 'data')))
+        from application import db
+        from application.models import User
+        with app.app_context():
+            users = db.session.query(User).count()
+
+        results = []
+        for name, call in benchmarks(app, users, random.Random(args.seed)):
+            if args.only and name not in args.only:
+                continue
+            latencies, elapsed, errors = run(call, args.duration, args.minimum, args.warmup)
+            results.append(report.summarize(name, latencies, elapsed, errors))
+        with app.app_context():
+            db.engine.dispose()
+
+    settings = {"data": path.abspath(args.data), "users": users, "duration": args.duration, "seed": args.seed}
+    raise SystemExit(report.report(results, args, settings))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+# SQL statements and rows fetched by one request to every route, measured
+# on a scratch copy of a generated dataset at several input sizes and
+# checked against a budget file. A route whose statement count grows with
+# the size of its input, such as the number of users requested or accounts
+# followed, fails the check whatever its budget.
+#
+#   python -m benchmarks.queries --data /tmp/flashpaper-bench [--budget FILE]
+#       [--update] [--verbose]
+from .dataset import LOCAL_DOMAIN, avatar_image, basic_auth, copy_dataset, create_app, username
+from argparse import ArgumentParser
+from collections import Counter
+from tempfile import TemporaryDirectory
+from threading import get_ident
+from os import path
+import json
+import random
+import re
+import sqlite3
+
+SIZES = (1, 10, 100)
+DEFAULT_BUDGET = path.join(path.dirname(path.abspath(__file__)), 'query_budget.json')
+
+class QueryCounter:
+    # Statements run and rows fetched by the thread being measured
+    def __init__(self):
+        self.thread = None
+        self.statements = []
+        self.rows = 0
+
+    def start(self):
+        self.statements = []
+        self.rows = 0
+        self.thread = get_ident()
+
+    def stop(self):
+        self.thread = None
+
+    def active(self):
+        return self.thread == get_ident()
+
+    def before_cursor_execute(self, connection, cursor, statement, parameters, context, executemany):
+        if self.active():
+            self.statements.append(statement)
+
+counter = QueryCounter()
+
+class CountingCursor(sqlite3.Cursor):
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None and counter.active():
+            counter.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        if counter.active():
+            counter.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        if counter.active():
+            counter.rows += len(rows)
+        return rows
+
+class CountingConnection(sqlite3.Connection):
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+def shape(statement: str):
+    # The statement with its parameter lists collapsed, to spot repeats
+    return re.sub(r"\(\?(, \?)*\)", "(?...)", " ".join(statement.split()))[:120]
+
+def scenarios(app, users: int, rng: random.Random):
+    # Yields (name, sized, prepare) triples. prepare(size) puts the data in
+    # place for an input of that size and returns the request to measure, a
+    # call returning whether it got the expected response. Routes without
+    # a sized input are measured once.
+    from application import db
+    from application.models import User, UserAvatar, UserFollow, UserWebhook
+    from sqlalchemy import delete, insert
+    client = app.test_client()
+    app.config['SERVER_DOMAIN'] = LOCAL_DOMAIN
+    app.config['WEBHOOKS_ENABLED'] = True
+    app.config['MAX_WEBHOOKS'] = max(SIZES) + 1
+    app.config['BATCH_STREAM_MIN_USERS'] = max(SIZES) + 1
+
+    def random_users(size: int):
+        return [username(i) for i in rng.sample(range(users), min(size, users))]
+
+    def user_id(name: str):
+        return db.session.query(User.id).filter_by(username=name).scalar()
+
+    def set_rows(model, name: str, rows: list):
+        # Replace what a user has of model with rows
+        with app.app_context():
+            uid = user_id(name)
+            db.session.execute(delete(model.__table__).where(model.__table__.c.user_id == uid))
+            if rows:
+                db.session.execute(insert(model.__table__), [dict(row, user_id=uid) for row in rows])
+            db.session.commit()
+
+    def batch(route: str):
+        def prepare(size: int):
+            query = "&".join("user={}".format(name) for name in random_users(size))
+            return lambda: client.get(route + query).status_code == 200
+        return prepare
+    yield "GET /users", True, batch('/.well-known/fmrl/users?')
+    yield "GET /users/changes", True, batch('/.well-known/fmrl/users/changes?since=0&')
+
+    def stream(size: int):
+        query = "&".join("user={}".format(name) for name in random_users(size))
+        def call():
+            # The first event holds the lookups; the stream is dropped after it
+            response = client.get('/.well-known/fmrl/users/stream?' + query, buffered=False)
+            ok = response.status_code == 200 and next(iter(response.response), None) is not None
+            response.close()
+            return ok
+        return call
+    yield "GET /users/stream", True, stream
+
+    def following(route: str):
+        def prepare(size: int):
+            name = random_users(1)[0]
+            set_rows(UserFollow, name, [{"username": "@{}@{}".format(other, LOCAL_DOMAIN)} for other in random_users(size)])
+            return lambda: client.get(route.format(name), headers={"Authorization": basic_auth(name)}).status_code == 200
+        return prepare
+    yield "GET /user/following", True, following('/.well-known/fmrl/user/{}/following')
+    yield "GET /user/following/statuses", True, following('/.well-known/fmrl/user/{}/following/statuses')
+
+    def follow_patch(size: int):
+        name = random_users(1)[0]
+        set_rows(UserFollow, name, [])
+        followed = ["@{}@{}".format(other, LOCAL_DOMAIN) for other in random_users(size)]
+        return lambda: client.patch('/.well-known/fmrl/user/{}/following'.format(name), json={"add": followed},
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "PATCH /user/following", True, follow_patch
+
+    def webhooks(size: int):
+        name = random_users(1)[0]
+        set_rows(UserWebhook, name, [{"url": "https://hooks.example/{}".format(i), "method": "POST"} for i in range(size)])
+        return lambda: client.get('/.well-known/fmrl/user/{}/webhooks'.format(name),
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "GET /user/webhooks", True, webhooks
+
+    def webhook_post(size: int):
+        name = random_users(1)[0]
+        set_rows(UserWebhook, name, [])
+        return lambda: client.post('/.well-known/fmrl/user/{}/webhooks'.format(name),
+            json={"url": "https://hooks.example/new", "method": "POST"},
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "POST /user/webhooks", False, webhook_post
+
+    def webhook_delete(size: int):
+        name = random_users(1)[0]
+        set_rows(UserWebhook, name, [{"url": "https://hooks.example/old", "method": "POST"}])
+        with app.app_context():
+            webhook_id = db.session.query(UserWebhook.id).filter_by(user_id=user_id(name)).scalar()
+        return lambda: client.delete('/.well-known/fmrl/user/{}/webhooks/{}'.format(name, webhook_id),
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "DELETE /user/webhooks", False, webhook_delete
+
+    def status_patch(size: int):
+        name = random_users(1)[0]
+        return lambda: client.patch('/.well-known/fmrl/user/{}'.format(name), json={"status": "measured"},
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "PATCH /user", False, status_patch
+
+    def avatar_upload(size: int):
+        name = random_users(1)[0]
+        image = avatar_image(rng, 256)
+        return lambda: client.put('/.well-known/fmrl/user/{}/avatar'.format(name), data=image,
+            headers={"Authorization": basic_auth(name)}).status_code == 200
+    yield "PUT /user/avatar", False, avatar_upload
+
+    def avatar_serve(size: int):
+        with app.app_context():
+            name = db.session.query(User.username).join(UserAvatar, UserAvatar.user_id == User.id) \
+                .filter(UserAvatar.original.isnot(None)).limit(1).scalar()
+        return lambda: name is not None and client.get('/.well-known/fmrl/avatars/{}'.format(name)).status_code == 200
+    yield "GET /avatars", False, avatar_serve
+
+def measure(call):
+    # Caches are emptied first, so every request does its full work
+    from application import credential_cache, status_cache
+    status_cache.clear()
+    credential_cache.clear()
+    counter.start()
+    try:
+        ok = call()
+    finally:
+        counter.stop()
+    return ok, list(counter.statements), counter.rows
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--data', required=True, help="Dataset created by benchmarks.dataset")
+    parser.add_argument('--budget', default=DEFAULT_BUDGET, help="Budget file (default benchmarks/query_budget.json)")
+    parser.add_argument('--update', action='store_true', help="Write the measurements to the budget file")
+    parser.add_argument('--verbose', action='store_true', help="List the statements of every request")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = {}
+    with TemporaryDirectory() as scratch:
+        app = create_app(copy_dataset(args.data, path.join(scratch, 'data')), {"factory": CountingConnection})
+        from application import db
+        from application.models import User
+        from sqlalchemy import event
+        with app.app_context():
+            event.listen(db.engine, "before_cursor_execute", counter.before_cursor_execute)
+            users = db.session.query(User).count()
+
+        for name, sized, prepare in scenarios(app, users, random.Random(args.seed)):
+            measurements = []
+            for size in SIZES if sized else SIZES[:1]:
+                ok, statements, rows = measure(prepare(size))
+                if not ok:
+                    print("{}: unexpected response at size {}".format(name, size))
+                measurements.append({"size": size, "statements": len(statements), "rows": rows})
+                if args.verbose:
+                    print("{} [{}]".format(name, size))
+                    for statement, count in Counter(shape(statement) for statement in statements).items():
+                        print("  {:>4}x {}".format(count, statement))
+            results[name] = measurements
+        # Uploads are transcoded in the background, within the scratch copy
+        from application import avatar_transcoder
+        if avatar_transcoder.executor is not None:
+            avatar_transcoder.executor.shutdown(wait=True)
+        with app.app_context():
+            db.engine.dispose()
+
+    budget = {}
+    if path.exists(args.budget) and not args.update:
+        with open(args.budget) as file:
+            budget = json.load(file)
+
+    failures = []
+    print("{:<30} {:>28} {:>28} {:>10}".format("route", "statements by size", "rows by size", "budget"))
+    for name, measurements in results.items():
+        statements = [measurement["statements"] for measurement in measurements]
+        rows = [measurement["rows"] for measurement in measurements]
+        limit = budget.get(name, {}).get("statements")
+        problems = []
+        if statements[-1] > statements[0]:
+            problems.append("grows with input size")
+        if limit is not None and max(statements) > limit:
+            problems.append("over budget")
+        if budget and limit is None:
+            problems.append("no budget")
+        print("{:<30} {:>28} {:>28} {:>10}  {}".format(name, "/".join(map(str, statements)), "/".join(map(str, rows)),
+            "" if limit is None else limit, ", ".join(problems)))
+        if problems:
+            failures.append(name)
+
+    if args.update:
+        with open(args.budget, 'w') as file:
+            json.dump({name: {"statements": max(measurement["statements"] for measurement in measurements)}
+                for name, measurements in results.items()}, file, indent=2)
+            file.write("\n")
+        print("Budgets written to {}".format(args.budget))
+    if failures:
+        print("Failed: {}".format(", ".join(failures)))
+    raise SystemExit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+# Summaries of benchmark runs, saved as JSON and compared with a baseline
+from datetime import datetime
+import json
+import platform
+import sys
+
+def percentile(latencies: list, fraction: float):
+    # Nearest-rank percentile of already sorted latencies
+    if not latencies:
+        return 0.0
+    index = max(0, min(len(latencies) - 1, int(round(fraction * len(latencies))) - 1))
+    return latencies[index]
+
+def summarize(name: str, latencies: list, elapsed: float, errors: int = 0):
+    latencies = sorted(latencies)
+    return {
+        "name": name,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+    }
+
+def add_arguments(parser):
+    parser.add_argument('--save', metavar='FILE', help="Write the results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE', help="Compare with results saved by an earlier run")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+        help="Percent slower than the baseline reported as a regression (default 10)")
+
+def change(current: float, previous: float):
+    if not previous:
+        return None
+    return (current - previous) / previous * 100
+
+def format_change(value):
+    return "" if value is None else "{:+.1f}%".format(value)
+
+def report(results: list, args, settings: dict = None):
+    # Prints the results, saves them if asked and returns the exit status:
+    # 1 if any benchmark regressed past the tolerance against the baseline
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = {result["name"]: result for result in json.load(file)["results"]}
+
+    regressions = []
+    print("{:<28} {:>9} {:>12} {:>10} {:>10} {:>9} {:>9}".format(
+        "benchmark", "requests", "req/s", "p50 ms", "p99 ms", "req/s", "p99"))
+    for result in results:
+        previous = baseline.get(result["name"], {})
+        throughput_change = change(result["throughput"], previous.get("throughput"))
+        latency_change = change(result["p99_ms"], previous.get("p99_ms"))
+        print("{:<28} {:>9} {:>12.1f} {:>10.3f} {:>10.3f} {:>9} {:>9}".format(
+            result["name"], result["requests"], result["throughput"], result["p50_ms"], result["p99_ms"],
+            format_change(throughput_change), format_change(latency_change)))
+        if result["errors"]:
+            print("  {} errors".format(result["errors"]))
+        if (throughput_change is not None and throughput_change < -args.tolerance) or \
+                (latency_change is not None and latency_change > args.tolerance):
+            regressions.append(result["name"])
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({
+                "created": datetime.utcnow().replace(microsecond=0).isoformat(),
+                "python": sys.version.split()[0],
+                "platform": platform.platform(),
+                "settings": settings or {},
+                "results": results,
+            }, file, indent=2)
+    if regressions:
+        print("Regressed past {}%: {}".format(args.tolerance, ", ".join(regressions)))
+        return 1
+    return 0
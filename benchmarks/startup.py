@@ -0,0 +1,100 @@
+# Cold start cost of a worker: import time per top-level package, and the
+# time of each startup phase, measured in fresh interpreters.
+#
+#   python -m benchmarks.startup [--repeat 5] [--top 15] [--save FILE] [--baseline FILE]
+from argparse import ArgumentParser
+from statistics import median
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from os import environ, path
+import json
+import subprocess
+import sys
+
+repo_dir = path.dirname(path.dirname(path.abspath(__file__)))
+
+# Run in a fresh interpreter; prints the seconds taken by each phase
+PHASES = """
+import json, importlib
+from time import perf_counter
+timings = {}
+started = perf_counter()
+import application
+timings["import application"] = perf_counter() - started
+started = perf_counter()
+import wsgi
+timings["import routes and init_app"] = perf_counter() - started
+for name in application.LAZY_MODULES:
+    started = perf_counter()
+    importlib.import_module(name)
+    timings["first use of " + name] = perf_counter() - started
+from application.schema import upgrade_database
+started = perf_counter()
+upgrade_database()
+timings["upgrade_database"] = perf_counter() - started
+print(json.dumps(timings))
+"""
+
+def run(arguments: list, env: dict):
+    return subprocess.run([sys.executable] + arguments, cwd=repo_dir, env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+def import_times(env: dict):
+    # Self time of every module imported by the WSGI entry point, summed
+    # per top-level package, in milliseconds
+    totals = {}
+    output = run(['-X', 'importtime', '-c', 'import wsgi'], env).stderr
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, _, name = line[len("import time:"):].split("|")
+        package = name.strip().split(".")[0]
+        totals[package] = totals.get(package, 0) + int(own) / 1000
+    return totals
+
+def wall_time(arguments: list, env: dict):
+    started = perf_counter()
+    run(arguments, env)
+    return (perf_counter() - started) * 1000
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5, help="Fresh interpreters per measurement")
+    parser.add_argument('--top', type=int, default=15, help="Packages to list by import time")
+    parser.add_argument('--save', metavar='FILE', help="Write the results to FILE as JSON")
+    parser.add_argument('--baseline', metavar='FILE', help="Compare with results saved by an earlier run")
+    args = parser.parse_args()
+
+    samples = {}
+    with TemporaryDirectory() as scratch:
+        env = dict(environ, FLASK_ENV='production', FLASK_APP='cli.py',
+            FLASHPAPER_DATABASE_URL="sqlite:///{}".format(path.join(scratch, 'flashpaper.db')),
+            FLASHPAPER_AVATARS_DIR=scratch)
+        for _ in range(args.repeat):
+            samples.setdefault("process: python", []).append(wall_time(['-c', 'pass'], env))
+            samples.setdefault("process: import wsgi", []).append(wall_time(['-c', 'import wsgi'], env))
+            samples.setdefault("process: cli --help", []).append(wall_time(['-m', 'flask', '--help'], env))
+            for name, seconds in json.loads(run(['-c', PHASES], env).stdout).items():
+                samples.setdefault("phase: " + name, []).append(seconds * 1000)
+            for package, milliseconds in import_times(env).items():
+                samples.setdefault("import: " + package, []).append(milliseconds)
+
+    results = {name: median(values + [0] * (args.repeat - len(values))) for name, values in samples.items()}
+    imports = sorted((name for name in results if name.startswith("import: ")), key=results.get, reverse=True)
+    shown = [name for name in results if not name.startswith("import: ")] + imports[:args.top]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)["results"]
+    print("{:<48} {:>10} {:>10}".format("median of {} runs".format(args.repeat), "ms", "baseline"))
+    for name in shown:
+        previous = baseline.get(name)
+        print("{:<48} {:>10.1f} {:>10}".format(name, results[name], "" if previous is None else "{:.1f}".format(previous)))
+
+    if args.save:
+        with open(args.save, 'w') as file:
+            json.dump({"python": sys.version.split()[0], "repeat": args.repeat, "results": results}, file, indent=2)
+
+if __name__ == "__main__":
+    main()
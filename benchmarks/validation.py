@@ -0,0 +1,131 @@
+# Compares the status PATCH validator with the jsonschema based checks it
+# replaced, then times both.
+#
+#   python -m benchmarks.validation [--cases N] [--seed S] [--number N]
+from application.validation import validate_status_update
+from emoji_data import EmojiSequence
+from rfc3986 import is_valid_uri, normalize_uri
+from argparse import ArgumentParser
+from timeit import Timer
+import jsonschema
+import random
+import re
+
+LENGTH_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'maxLength': 40},
+        'status': {'maxLength': 100},
+        'media': {'maxLength': 100},
+    },
+    'additionalProperties': True,
+}
+
+TYPE_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'name': {'type': 'string'},
+        'status': {'type': 'string'},
+        'emoji': {'type': 'string'},
+        'media': {'type': 'string'},
+        'media_type': {'type': 'integer'},
+        'uri': {'type': 'string'},
+    },
+    'additionalProperties': True,
+}
+
+def reference_validate(payload):
+    # The previous update_user_status checks, with the name length enforced
+    try:
+        jsonschema.validate(payload, LENGTH_SCHEMA)
+    except jsonschema.ValidationError:
+        return None, (413, "Update field(s) too long!")
+    try:
+        jsonschema.validate(payload, TYPE_SCHEMA)
+    except jsonschema.ValidationError:
+        return None, (400, "Update fields not a valid type")
+
+    update = {}
+    if payload.get('avatar') is not None:
+        return None, (400, "Invalid endpoint for updating avatar")
+
+    if payload.get('emoji') is not None:
+        if not payload['emoji'] in EmojiSequence and payload['emoji']:
+            return None, (400, "Invalid emoji")
+        update['emoji'] = payload['emoji']
+
+    regex = re.compile('[\u0000-\u001F\u007F\u0080-\u009F]')
+    for field in {"status", "media", "name"}:
+        if payload.get(field) is not None:
+            if regex.search(payload.get(field)) is not None:
+                return None, (400, "Invalid unicode character(s)")
+            update[field] = payload[field]
+
+    if payload.get('media_type') is not None:
+        update['media_type'] = payload['media_type']
+
+    if payload.get('uri') is not None:
+        if not is_valid_uri(payload['uri']) or len(payload['uri'].encode('utf-8')) > 500:
+            return None, (400, "Invalid URI")
+        update['uri'] = normalize_uri(payload['uri'])
+    return update, None
+
+def text(rng: random.Random, limit: int):
+    alphabet = "abcdefghij klmnopé中\U0001F600\t\u0085\u007f"
+    return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, limit)))
+
+def random_value(rng: random.Random, field: str):
+    choice = rng.random()
+    if choice < 0.1:
+        return rng.choice([None, 1, 1.0, 1.5, True, [], {}, ""])
+    if field == 'emoji':
+        return rng.choice(["\U0001F600", "❤️", "x", "", "\U0001F600\U0001F600"])
+    if field == 'media_type':
+        return rng.choice([0, 1, 2, -1, 2.0, "1"])
+    if field == 'uri':
+        return rng.choice(["https://example.com/a", "HTTPS://Example.COM/%7euser", "not a uri",
+            "https://example.com/" + "a" * 490, "mailto:someone@example.com", ""])
+    if field == 'avatar':
+        return rng.choice([None, "x"])
+    return text(rng, 120)
+
+def random_payload(rng: random.Random):
+    if rng.random() < 0.02:
+        return rng.choice([None, [], "status", 1])
+    fields = ['name', 'status', 'emoji', 'media', 'media_type', 'uri', 'avatar', 'extra']
+    return {field: random_value(rng, field) for field in fields if rng.random() < 0.4}
+
+# Typical updates sent by clients, used for timing
+SAMPLES = [
+    {'status': "Working from the garden today", 'emoji': "\U0001F33B"},
+    {'name': "Alice", 'status': "Listening to", 'media': "Some Song - Some Artist", 'media_type': 1},
+    {'status': "", 'emoji': "", 'uri': "https://example.com/profile"},
+]
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--cases', type=int, default=20000, help="Random payloads to compare")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--number', type=int, default=2000, help="Timing iterations per sample")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    mismatches = 0
+    for _ in range(args.cases):
+        payload = random_payload(rng)
+        expected = reference_validate(payload)
+        actual = validate_status_update(payload)
+        if actual != expected:
+            mismatches += 1
+            if mismatches <= 10:
+                print("Mismatch for {!r}: expected {!r}, got {!r}".format(payload, expected, actual))
+    print("{} payloads compared, {} mismatches".format(args.cases, mismatches))
+
+    for name, validate in (("reference", reference_validate), ("validator", validate_status_update)):
+        timer = Timer(lambda: [validate(sample) for sample in SAMPLES])
+        best = min(timer.repeat(repeat=5, number=args.number)) / (args.number * len(SAMPLES))
+        print("{:<10} {:8.2f} us/payload".format(name, best * 1e6))
+    return 1 if mismatches else 0
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -1,17 +1,94 @@
 import click
-from application import init_app
-from application.auth import create_user, delete_user
+from os import cpu_count
+from application import avatar_transcoder, db, init_app
+from application.auth import create_user, delete_user, set_user_password
+from application.avatars import is_blob, migrate_avatar
+from application.importer import UserImport
+from application.models import AvatarBlob, User, UserAvatar, UserChange
+from application.schema import create_schema
 
 app = init_app()
 
+@app.cli.command('upgrade-db')
+def upgrade_database():
+    create_schema(db.engine)
+    print("Database is up to date.")
+
+@app.cli.command('migrate-avatars')
+def migrate_avatars():
+    # Avatars uploaded before blob storage are kept under their username
+    from datetime import datetime
+    migrated = missing = 0
+    query = db.session.query(UserAvatar, User).join(User, UserAvatar.user_id == User.id) \
+        .filter(UserAvatar.original.isnot(None))
+    for avatar, user in query.all():
+        if is_blob(avatar):
+            continue
+        remove_files = migrate_avatar(avatar, user.username)
+        if remove_files is None:
+            missing += 1
+            db.session.rollback()
+            continue
+        # The avatar URLs change, so clients are told to fetch them again
+        user.last_updated = datetime.utcnow().replace(microsecond=0)
+        UserChange.record(user.username, 'avatar')
+        db.session.commit()
+        remove_files()
+        migrated += 1
+    print("Migrated {} avatars, {} missing their image.".format(migrated, missing))
+
+@app.cli.command('transcode-avatars')
+def transcode_avatars():
+    # Blobs stored before encodings were made, or moved by migrate-avatars
+    digests = [digest for digest, in db.session.query(AvatarBlob.digest).filter(AvatarBlob.encodings.is_(None),
+        AvatarBlob.refcount > 0)]
+    db.session.rollback()
+    missing = 0
+    for digest in digests:
+        try:
+            avatar_transcoder.transcode(digest)
+        except OSError:
+            db.session.rollback()
+            missing += 1
+    print("Transcoded {} avatars with {}, {} missing their image.".format(len(digests) - missing,
+        ", ".join(avatar_transcoder.available()) or "no encoder", missing))
+
 @app.cli.command('create-user')
 @click.argument('username', nargs=1, required=True)
 @click.argument('password', nargs=1, required=True)
 def create_new_user(username, password):
+    # User management may come before the server has ever started
+    create_schema(db.engine)
     create_user(username, password)
 
+@app.cli.command('set-password')
+@click.argument('username', nargs=1, required=True)
+@click.argument('password', nargs=1, required=True)
+def change_user_password(username, password):
+    create_schema(db.engine)
+    set_user_password(username, password)
+
 @app.cli.command('remove-user')
 @click.argument('username', nargs=1, required=True)
 def remove_user(username):
+    create_schema(db.engine)
     delete_user(username)
-    
\ No newline at end of file
+    
+
+@app.cli.command('import-users')
+@click.argument('input_path', nargs=1, required=True, type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'jsonl']), help="Defaults to the file extension")
+@click.option('--workers', type=int, default=cpu_count() or 1, help="Processes hashing passwords")
+@click.option('--batch-size', type=int, default=1000, help="Users per transaction")
+@click.option('--dry-run', is_flag=True, help="Validate and report without writing anything")
+@click.option('--resume', is_flag=True, help="Continue an interrupted import")
+def import_users(input_path, file_format, workers, batch_size, dry_run, resume):
+    create_schema(db.engine)
+    user_import = UserImport(input_path, file_format, workers, batch_size, dry_run)
+    try:
+        counts = user_import.run(resume)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    print("{} {} users, skipped {} existing, {} invalid and {} duplicate in {:.1f}s.".format(
+        "Would import" if dry_run else "Imported", counts["imported"], counts["existing"],
+        counts["invalid"], counts["duplicate"], user_import.elapsed))
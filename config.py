@@ -1,13 +1,59 @@
-from distutils.util import strtobool
 from os import path, environ
+from ipaddress import ip_network
+from sqlalchemy.pool import QueuePool
 
 app_dir= path.abspath(path.dirname(__file__))
 
+def strtobool(value: str):
+  # As distutils.util.strtobool, without importing the deprecated distutils
+  value = value.lower()
+  if value in ('y', 'yes', 't', 'true', 'on', '1'):
+    return 1
+  if value in ('n', 'no', 'f', 'false', 'off', '0'):
+    return 0
+  raise ValueError("invalid truth value {!r}".format(value))
+
+def networks(value: str):
+  # Comma separated addresses or CIDR ranges
+  return [ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
 class Config:
-  AVATARS_DIR = path.join(app_dir, 'avatars')
+  AVATARS_DIR = environ.get("FLASHPAPER_AVATARS_DIR", path.join(app_dir, 'avatars'))
   SQLALCHEMY_TRACK_MODIFICATIONS = False
+  SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',  # Durable with WAL, without an fsync per commit
+    'cache_size': -16000,  # 16 MB page cache per connection
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,  # Wait up to 5 s for another worker's write lock
+  }
   UPLOAD_MAX_SIZE = 4 * 1024 * 1024  # 4 MB
+  UPLOAD_CHUNK_SIZE = 64 * 1024  # Bytes read from the request per chunk
   ALLOWED_UPLOAD_TYPES = set(['image/jpeg', 'image/png'])
+  AVATAR_SIZES = (64, 128, 256, 512)  # Downscaled variants generated on upload
+  AVATAR_MAX_DIMENSION = 4096  # Largest accepted avatar width/height in pixels
+  AVATAR_MAX_DECODED_PIXELS = 2048 * 2048  # Largest image decoded to render variants, JPEGs at their reduced scale
+  AVATAR_MAX_AGE = 3600  # Cache-Control max-age for served avatars
+  AVATAR_IMMUTABLE_MAX_AGE = 31536000  # Cache-Control max-age for avatar URLs keyed by content hash
+  # Smaller encodings made of every avatar in the background, used when
+  # Pillow can write them and the client accepts them. Encoder options by format.
+  AVATAR_ENCODINGS = {
+    'avif': {'quality': 50, 'speed': 6},
+    'webp': {'quality': 80, 'method': 6},
+  }
+  AVATAR_TRANSCODE_WORKERS = 2  # Encoding threads per worker process
+
+  # Internal location prefix for nginx X-Accel-Redirect, e.g. /protected-avatars/
+  AVATAR_ACCEL_REDIRECT = environ.get("FLASHPAPER_ACCEL_REDIRECT")
+  LOOKUP_CHUNK_SIZE = 500  # Usernames per batch lookup query
+  BATCH_STREAM_MIN_USERS = 1000  # Batch lookups this large are streamed a chunk at a time
+
+  BATCH_MAX_BODY_SIZE = 2 * 1024 * 1024  # Bytes of a batch lookup POSTed as a form
+  try:
+    BATCH_MAX_USERS = int(environ.get("FLASHPAPER_BATCH_MAX_USERS", '10000'))  # Users per batch response, more are paged
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_BATCH_MAX_USERS. Defaulting to 10000.")
+    BATCH_MAX_USERS = 10000
 
   try:
     MAX_WEBHOOKS = int(environ.get("FLASHPAPER_WEBHOOKS_MAX", '3'))
@@ -15,12 +61,151 @@ class Config:
     print("Invalid value for FLASHPAPER_WEBHOOKS_MAX. Defaulting to 3.")
     MAX_WEBHOOKS = 3
 
+  try:
+    STATUS_CACHE_SIZE = int(environ.get("FLASHPAPER_STATUS_CACHE_SIZE", '10000'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_STATUS_CACHE_SIZE. Defaulting to 10000.")
+    STATUS_CACHE_SIZE = 10000
+
+  AUTH_CACHE_SIZE = 10000  # Verified credentials remembered per worker
+  try:
+    AUTH_CACHE_TTL = int(environ.get("FLASHPAPER_AUTH_CACHE_TTL", '60'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_AUTH_CACHE_TTL. Defaulting to 60.")
+    AUTH_CACHE_TTL = 60
+
   try:
     WEBHOOKS_ENABLED = strtobool(environ.get("FLASHPAPER_WEBHOOKS_ENABLED", 'False'))
   except ValueError:
     print("Invalid value for FLASHPAPER_WEBHOOKS_ENABLED. Defaulting to False.")
     WEBHOOKS_ENABLED = False
 
+  try:
+    USE_X_SENDFILE = strtobool(environ.get("FLASHPAPER_USE_SENDFILE", "False"))
+  except ValueError:
+    print("Invalid value for FLASHPAPER_USE_SENDFILE. Defaulting to False.")
+    USE_X_SENDFILE = False
+
+  # Response compression
+  COMPRESSION_MIN_SIZE = 1024  # Bytes, smaller bodies are sent uncompressed
+  try:
+    COMPRESSION_GZIP_LEVEL = int(environ.get("FLASHPAPER_GZIP_LEVEL", '6'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_GZIP_LEVEL. Defaulting to 6.")
+    COMPRESSION_GZIP_LEVEL = 6
+
+  try:
+    COMPRESSION_BROTLI_QUALITY = int(environ.get("FLASHPAPER_BROTLI_QUALITY", '5'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_BROTLI_QUALITY. Defaulting to 5.")
+    COMPRESSION_BROTLI_QUALITY = 5
+
+  # Prometheus metrics at /metrics
+  try:
+    METRICS_ENABLED = strtobool(environ.get("FLASHPAPER_METRICS_ENABLED", "False"))
+  except ValueError:
+    print("Invalid value for FLASHPAPER_METRICS_ENABLED. Defaulting to False.")
+    METRICS_ENABLED = False
+  METRICS_DIR = environ.get("FLASHPAPER_METRICS_DIR")  # Shared directory to sum metrics across workers
+  METRICS_FLUSH_INTERVAL = 5  # Seconds between writes of each worker's metrics
+
+  # Admission control: per-client and per-account token buckets charged by
+  # request cost, and load shedding while a worker is saturated
+  try:
+    ADMISSION_ENABLED = strtobool(environ.get("FLASHPAPER_ADMISSION_ENABLED", "False"))
+  except ValueError:
+    print("Invalid value for FLASHPAPER_ADMISSION_ENABLED. Defaulting to False.")
+    ADMISSION_ENABLED = False
+  RATE_LIMIT_DB = environ.get("FLASHPAPER_RATE_LIMIT_DB")  # SQLite file sharing buckets across workers
+
+  try:
+    RATE_LIMIT_CLIENT_RATE = float(environ.get("FLASHPAPER_RATE_LIMIT_CLIENT", '50'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_RATE_LIMIT_CLIENT. Defaulting to 50.")
+    RATE_LIMIT_CLIENT_RATE = 50.0
+
+  try:
+    RATE_LIMIT_ACCOUNT_RATE = float(environ.get("FLASHPAPER_RATE_LIMIT_ACCOUNT", '10'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_RATE_LIMIT_ACCOUNT. Defaulting to 10.")
+    RATE_LIMIT_ACCOUNT_RATE = 10.0
+
+  RATE_LIMIT_BURST = 5  # Seconds of their rate that buckets hold
+  RATE_LIMIT_CLIENT = (RATE_LIMIT_CLIENT_RATE, RATE_LIMIT_CLIENT_RATE * RATE_LIMIT_BURST)  # (cost per second, burst)
+  RATE_LIMIT_ACCOUNT = (RATE_LIMIT_ACCOUNT_RATE, RATE_LIMIT_ACCOUNT_RATE * RATE_LIMIT_BURST)
+  # A request costing more than a bucket holds is charged the full bucket
+  ADMISSION_COSTS = {
+    'request': 1,  # Every request
+    'batch_user': 0.01,  # Each user looked up, counted up to BATCH_MAX_USERS, so a full page costs 100
+    'upload_kib': 1 / 64,  # Each KiB of a request body, the upload limit when undeclared
+    'auth': 5,  # Requests sending credentials, for the password check
+  }
+
+  try:
+    ADMISSION_MAX_IN_FLIGHT = int(environ.get("FLASHPAPER_ADMISSION_MAX_IN_FLIGHT", '100'))  # Requests in progress per worker
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_ADMISSION_MAX_IN_FLIGHT. Defaulting to 100.")
+    ADMISSION_MAX_IN_FLIGHT = 100
+  ADMISSION_MAX_LATENCY = 1.0  # Seconds of average handler time before shedding, 0 to never shed on latency
+  ADMISSION_RETRY_AFTER = 1  # Seconds suggested to shed clients
+  ADMISSION_EXEMPT = set(['get_metrics'])  # Endpoints always admitted
+
+  # Webhooks and federation only connect to globally routable addresses,
+  # never loopback, private or link-local ones, unless allowed here
+  try:
+    OUTBOUND_ALLOW = networks(environ.get("FLASHPAPER_OUTBOUND_ALLOW", ""))  # e.g. 10.0.0.0/8,192.168.1.5
+  except ValueError:
+    print("Invalid value for FLASHPAPER_OUTBOUND_ALLOW. Defaulting to none.")
+    OUTBOUND_ALLOW = []
+  try:
+    OUTBOUND_DENY = networks(environ.get("FLASHPAPER_OUTBOUND_DENY", ""))  # Refused even if globally routable
+  except ValueError:
+    print("Invalid value for FLASHPAPER_OUTBOUND_DENY. Defaulting to none.")
+    OUTBOUND_DENY = []
+
+  # Webhook delivery
+  WEBHOOK_WORKERS = 16  # Concurrent deliveries per worker process
+  WEBHOOK_TIMEOUT = 5  # Seconds
+  WEBHOOK_RETRIES = 3
+  WEBHOOK_BACKOFF = 1.0  # Seconds before the first retry, doubled each time
+  WEBHOOK_COALESCE_DELAY = 0.5  # Seconds to gather repeated updates
+  WEBHOOK_FLUSH_INTERVAL = 1.0  # Seconds between writes of delivery results
+
+  # gunicorn worker settings, see gunicorn.conf.py
+  ASYNC_MODE = environ.get("FLASHPAPER_SERVER_MODE", "threaded").lower() == "async"
+  WORKER_THREADS = 32  # Threads per worker in threaded mode
+
+  # Status change streaming
+  try:
+    EVENTS_MAX_SUBSCRIBERS = int(environ.get("FLASHPAPER_EVENTS_MAX_SUBSCRIBERS", '1000'))  # Open streams per worker process
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_EVENTS_MAX_SUBSCRIBERS. Defaulting to 1000.")
+    EVENTS_MAX_SUBSCRIBERS = 1000
+  # Every stream holds a thread in threaded mode, so streams are limited to
+  # the threads left after keeping this many for other requests
+  EVENTS_RESERVED_THREADS = 8
+  EVENTS_MAX_USERS = 1000  # Usernames per stream
+  EVENTS_HEARTBEAT = 15  # Seconds between keepalive comments
+  EVENTS_POLL_INTERVAL = 0.5  # Seconds between checks for other workers' changes
+
+  # Federated following feed
+  SERVER_DOMAIN = environ.get("FLASHPAPER_DOMAIN")  # Defaults to the request host
+  FEDERATION_SCHEME = 'https'
+  FEDERATION_ENDPOINTS = {}  # Host to base URL overrides, e.g. for local stand-in servers
+  FEDERATION_WORKERS = 16  # Concurrent upstream requests per worker process
+  FEDERATION_TIMEOUT = 5  # Seconds
+  FEDERATION_BATCH_SIZE = 100  # Usernames per upstream request
+  FEDERATION_CACHE_TTL = 30  # Seconds before upstream statuses are revalidated
+  FEDERATION_CACHE_SIZE = 50000
+
+  # Create and upgrade tables when the app starts. Production leaves this to
+  # the gunicorn master or the upgrade-db command, so workers boot faster.
+  try:
+    SCHEMA_ON_STARTUP = strtobool(environ.get("FLASHPAPER_SCHEMA_ON_STARTUP", "False"))
+  except ValueError:
+    print("Invalid value for FLASHPAPER_SCHEMA_ON_STARTUP. Defaulting to False.")
+    SCHEMA_ON_STARTUP = False
+
   try:
     IS_PROXIED = strtobool(environ.get("FLASHPAPER_USING_PROXY", "False"))
   except ValueError:
@@ -28,13 +213,20 @@ class Config:
     IS_PROXIED = False
 
 class ProductionConfig(Config):
-  SQLALCHEMY_DATABASE_URI = "sqlite:///{}".format(path.join(app_dir, 'data', 'flashpaper.db'))
+  SQLALCHEMY_DATABASE_URI = environ.get("FLASHPAPER_DATABASE_URL",
+    "sqlite:///{}".format(path.join(app_dir, 'data', 'flashpaper.db')))
+  SQLALCHEMY_ENGINE_OPTIONS = {'pool_size': 5, 'max_overflow': 10, 'pool_pre_ping': True}
+  if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    # SQLAlchemy defaults to opening a new connection per checkout for SQLite
+    SQLALCHEMY_ENGINE_OPTIONS = {'poolclass': QueuePool, 'pool_size': 5, 'max_overflow': 10,
+      'connect_args': {'check_same_thread': False}}
   FLASK_ENV = 'production'
   DEBUG = False
   TESTING = False
 
 class DevelopmentConfig(Config):
   SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
+  SCHEMA_ON_STARTUP = True
   FLASK_ENV = 'development'
   DEBUG = True
   TESTING = True
@@ -0,0 +1,80 @@
+# gunicorn settings for both serving modes, chosen with FLASHPAPER_SERVER_MODE:
+#   threaded  gthread workers, a thread per connection (default)
+#   async     gevent workers, connections served on an event loop, so slow
+#             clients, uploads, streams and outbound requests only cost a
+#             greenlet each. Needs the packages in requirements-async.txt.
+from os import environ
+import gc
+
+server_mode = environ.get("FLASHPAPER_SERVER_MODE", "threaded").lower()
+if server_mode not in ("threaded", "async"):
+  print("Invalid value for FLASHPAPER_SERVER_MODE. Defaulting to threaded.")
+  server_mode = "threaded"
+
+if server_mode == "async":
+  # Patch before the app is imported, so its locks and thread-locals
+  # cooperate with the event loop even when preloaded in the master
+  from gevent import monkey
+  monkey.patch_all()
+  worker_class = "gevent"
+  try:
+    worker_connections = int(environ.get("FLASHPAPER_WORKER_CONNECTIONS", '2000'))
+  except (TypeError, ValueError):
+    print("Invalid value for FLASHPAPER_WORKER_CONNECTIONS. Defaulting to 2000.")
+    worker_connections = 2000
+else:
+  from config import Config
+  worker_class = "gthread"
+  threads = Config.WORKER_THREADS
+
+# Batch lookups name every user in the query string. Allow the longest
+# request line gunicorn can bound, about 180 users; larger batches are
+# POSTed as a form.
+limit_request_line = 8190
+
+# Import the app once in the master and fork workers from it. Workers then
+# start without importing anything, but code changes need a full restart
+# rather than a HUP.
+from config import strtobool
+try:
+  preload_app = bool(strtobool(environ.get("FLASHPAPER_PRELOAD", "True")))
+except ValueError:
+  print("Invalid value for FLASHPAPER_PRELOAD. Defaulting to True.")
+  preload_app = True
+
+def on_starting(server):
+  # Create and upgrade the database once, before any worker starts
+  from application.schema import upgrade_database
+  upgrade_database()
+  fold_metrics()
+
+def child_exit(server, worker):
+  fold_metrics(worker.pid)
+
+def fold_metrics(pid=None):
+  # Keep the metrics of exited workers, or of every worker of an earlier
+  # run, in the totals shared through METRICS_DIR
+  from config import Config
+  if not Config.METRICS_ENABLED or not Config.METRICS_DIR:
+    return
+  from application.metrics import fold_exited
+  fold_exited(Config.METRICS_DIR, pid)
+
+def when_ready(server):
+  if not preload_app:
+    return
+  # Load what the app would otherwise import on first use, and keep the
+  # collector from touching the shared objects so their pages stay shared
+  from application import preload_modules
+  preload_modules()
+  gc.freeze()
+
+def post_fork(server, worker):
+  # Let psycopg2 wait on PostgreSQL without blocking the event loop
+  if server_mode != "async":
+    return
+  try:
+    from psycogreen.gevent import patch_psycopg
+  except ImportError:
+    return
+  patch_psycopg()
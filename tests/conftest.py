@@ -0,0 +1,45 @@
+# One application for the whole session, as routes are registered on the
+# first app created. It runs the production config against a SQLite file
+# in a scratch directory, which is removed afterwards together with the
+# environment it was configured through.
+#
+#   python -m pytest tests
+from tempfile import TemporaryDirectory
+from os import environ, path
+import importlib
+import pytest
+
+@pytest.fixture(scope="session")
+def scratch():
+    with TemporaryDirectory() as directory:
+        yield directory
+
+@pytest.fixture(scope="session")
+def app(scratch):
+    import config
+    saved = dict(environ)
+    environ.update({
+        'FLASK_ENV': "production",
+        'FLASHPAPER_DATABASE_URL': "sqlite:///{}".format(path.join(scratch, 'flashpaper.db')),
+        'FLASHPAPER_AVATARS_DIR': scratch,
+        'FLASHPAPER_SCHEMA_ON_STARTUP': "TRUE",
+        # Stub servers listen on loopback
+        'FLASHPAPER_OUTBOUND_ALLOW': "127.0.0.0/8",
+    })
+    try:
+        # The config reads the environment when imported
+        importlib.reload(config)
+        from application import db, init_app
+        app = init_app()
+        yield app
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        environ.clear()
+        environ.update(saved)
+        importlib.reload(config)
+
+@pytest.fixture(scope="session")
+def client(app):
+    return app.test_client()
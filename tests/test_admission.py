@@ -0,0 +1,56 @@
+# Admission control on an application of its own, as it is configured
+# when the application starts
+from base64 import b64encode
+from time import perf_counter, sleep
+import io
+import pytest
+
+class SlowStream(io.BytesIO):
+    # A client taking its time to send the body
+    def read(self, *args):
+        sleep(0.2)
+        return super().read(*args)
+
+@pytest.fixture
+def admission(app):
+    from flask import Flask, request
+    from application.admission import AdmissionControl
+    admitted = Flask(__name__)
+    admitted.config.update(app.config, ADMISSION_ENABLED=True)
+
+    @admitted.route('/upload', methods=['PUT'])
+    def upload():
+        return str(len(request.stream.read()))
+
+    @admitted.route('/slow')
+    def slow():
+        sleep(0.2)
+        return "done"
+
+    return AdmissionControl(admitted), admitted.test_client()
+
+def test_largest_upload_with_credentials_is_admitted(app, admission):
+    control, client = admission
+    data = b"\0" * app.config['UPLOAD_MAX_SIZE']
+    credentials = b64encode(b"alice:secret").decode()
+    response = client.put('/upload', data=data, headers={'Authorization': 'Basic ' + credentials})
+    assert response.status_code == 200
+    # It drained the account's bucket, so the next one waits
+    response = client.put('/upload', data=data, headers={'Authorization': 'Basic ' + credentials})
+    assert response.status_code == 429
+
+def test_latency_leaves_out_slow_uploads(admission):
+    control, client = admission
+    data = b"\0" * 1024
+    response = client.put('/upload', input_stream=SlowStream(data), content_length=len(data))
+    assert response.status_code == 200
+    assert control.latency < 0.01
+    client.get('/slow')
+    assert 0.01 < control.latency < 0.05
+
+def test_latency_fades_while_idle(admission):
+    control, client = admission
+    control.latency = 10.0
+    control.latency_updated = perf_counter() - 10 * control.LATENCY_HALF_LIFE
+    with control.lock:
+        assert control.recent_latency(perf_counter()) < 0.01
@@ -0,0 +1,86 @@
+# Avatar blob reference counting under concurrent uploads, on a file
+# backed SQLite database so every thread has a connection of its own.
+from base64 import b64encode
+from threading import Barrier, Thread
+from os import path, walk
+import io
+import random
+
+def image(seed: int):
+    from PIL import Image
+    rng = random.Random(seed)
+    file = io.BytesIO()
+    Image.frombytes('RGB', (96, 96), rng.randbytes(96 * 96 * 3)).resize((300, 300)).save(file, 'PNG')
+    return file.getvalue()
+
+def upload(client, username: str, data: bytes):
+    credentials = b64encode("{}:secret".format(username).encode()).decode()
+    return client.put('/.well-known/fmrl/user/{}/avatar'.format(username), data=data,
+        headers={'Authorization': 'Basic ' + credentials}).status_code
+
+def check_references(app):
+    # Every blob is referenced exactly as often as avatars show it, and
+    # every avatar's files are in place
+    from application import db
+    from application.avatars import blob_path
+    from application.models import AvatarBlob, UserAvatar
+    with app.app_context():
+        shown = {}
+        for avatar in UserAvatar.query.filter(UserAvatar.digest.isnot(None)):
+            shown[avatar.digest] = shown.get(avatar.digest, 0) + 1
+            assert path.exists(blob_path(avatar.digest))
+        blobs = {blob.digest: blob.refcount for blob in AvatarBlob.query.filter(AvatarBlob.refcount > 0)}
+        assert blobs == shown
+        db.session.rollback()
+
+def stored_digests(scratch: str):
+    return {name for _, _, names in walk(path.join(scratch, 'blobs-sha256')) for name in names if "." not in name}
+
+def test_concurrent_replace_keeps_shared_blob(app, client, scratch):
+    from application import db
+    from application.auth import create_user
+    from application.models import User, UserAvatar
+    with app.app_context():
+        for username in ('alice', 'bob'):
+            create_user(username, 'secret')
+    shared = image(0)
+    assert upload(client, 'alice', shared) == 200
+    assert upload(client, 'bob', shared) == 200
+
+    for attempt in range(5):
+        # Two uploads by alice racing to replace the avatar she shares with bob
+        barrier = Barrier(2)
+        statuses = []
+        def replace(seed: int):
+            data = image(seed)
+            barrier.wait()
+            statuses.append(upload(client, 'alice', data))
+        threads = [Thread(target=replace, args=(attempt * 2 + seed + 1,)) for seed in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert statuses == [200, 200]
+
+        assert client.get('/.well-known/fmrl/avatars/bob').status_code == 200
+        check_references(app)
+
+    # Only the shared image and alice's current one are left on disk
+    with app.app_context():
+        current = db.session.query(UserAvatar.digest).join(User, UserAvatar.user_id == User.id) \
+            .filter(User.username == 'alice').scalar()
+        db.session.rollback()
+    assert len(stored_digests(scratch)) == 2 and current in stored_digests(scratch)
+
+def test_oversized_png_refused_from_header(app, client, monkeypatch):
+    from PIL import Image
+    from application import routes
+    from application.auth import create_user
+    with app.app_context():
+        create_user('carol', 'secret')
+    file = io.BytesIO()
+    Image.new('RGB', (3000, 3000)).save(file, 'PNG')
+    spooled = []
+    monkeypatch.setattr(routes, 'spool_upload', lambda *args: spooled.append(args))
+    assert upload(client, 'carol', file.getvalue()) == 400
+    assert not spooled
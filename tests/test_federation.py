@@ -0,0 +1,71 @@
+# Statuses of followed accounts on another server, fetched from a stub
+# fmrl server on loopback standing in for it
+from base64 import b64encode
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import json
+import pytest
+
+class StubServer(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get('If-Modified-Since'))
+        body = json.dumps([{"username": name, "code": 200, "data": {"status": status}}
+            for name, status in server.statuses.items()]).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def date_time_string(self, timestamp=None):
+        # The clock of the server, as the tests set it
+        return self.server.date
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture
+def remote(app, monkeypatch):
+    from application import federation_client
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubServer)
+    server.requests = []
+    server.statuses = {"bob": "hello"}
+    server.date = "Sat, 17 Oct 2026 10:00:00 GMT"
+    Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(federation_client, 'endpoints', {"remote.test": "http://127.0.0.1:{}".format(server.server_address[1])})
+    # Every lookup goes upstream
+    monkeypatch.setattr(federation_client, 'ttl', -1)
+    yield server
+    federation_client.entries.clear()
+    server.shutdown()
+    server.server_close()
+
+def test_unchanged_status_keeps_its_time(remote):
+    from application import federation_client
+    first = federation_client.fetch(["@bob@remote.test"])["@bob@remote.test"]
+    remote.date = "Sat, 17 Oct 2026 10:05:00 GMT"
+    again = federation_client.fetch(["@bob@remote.test"])["@bob@remote.test"]
+    assert again.last_updated == first.last_updated
+    assert remote.requests[-1] == first.last_modified
+
+    remote.statuses["bob"] = "goodbye"
+    changed = federation_client.fetch(["@bob@remote.test"])["@bob@remote.test"]
+    assert changed.last_updated > first.last_updated
+
+def test_feed_carries_last_modified(app, client, remote):
+    from application.auth import create_user
+    with app.app_context():
+        create_user('dave', 'secret')
+    headers = {'Authorization': 'Basic ' + b64encode(b"dave:secret").decode()}
+    response = client.patch('/.well-known/fmrl/user/dave/following', json={"add": ["@bob@remote.test"]}, headers=headers)
+    assert response.status_code == 200
+
+    response = client.get('/.well-known/fmrl/user/dave/following/statuses', headers=headers)
+    assert response.status_code == 200
+    assert response.headers['Last-Modified'] == "Sat, 17 Oct 2026 09:59:59 GMT"
+    # Sent back, nothing in the feed is newer
+    remote.date = "Sat, 17 Oct 2026 10:05:00 GMT"
+    response = client.get('/.well-known/fmrl/user/dave/following/statuses',
+        headers=dict(headers, **{'If-Modified-Since': response.headers['Last-Modified']}))
+    assert response.json == [{"username": "@bob@remote.test", "code": 304}]
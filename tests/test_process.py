@@ -0,0 +1,17 @@
+# Components start their threads once per process, again after a fork
+from os import _exit, fork, getpid, waitpid
+
+def test_starts_again_after_fork():
+    from application.process import ProcessStart
+    calls = []
+    start = ProcessStart(lambda: calls.append(getpid()))
+    start()
+    start()
+    assert calls == [getpid()]
+    child = fork()
+    if child == 0:
+        start()
+        start()
+        _exit(0 if calls[1:] == [getpid()] else 1)
+    assert waitpid(child, 0)[1] == 0
+    assert calls == [getpid()]
@@ -0,0 +1,17 @@
+# The status PATCH validator agrees with the jsonschema based checks it
+# replaced. benchmarks.validation keeps those checks and times both.
+import random
+import pytest
+
+# No longer a requirement of the application itself
+pytest.importorskip("jsonschema")
+# The reference checks use rfc3986 calls it deprecates
+pytestmark = pytest.mark.filterwarnings("ignore::DeprecationWarning")
+
+def test_validator_matches_reference():
+    from application.validation import validate_status_update
+    from benchmarks.validation import random_payload, reference_validate
+    rng = random.Random(0)
+    for _ in range(5000):
+        payload = random_payload(rng)
+        assert validate_status_update(payload) == reference_validate(payload), payload
@@ -0,0 +1,78 @@
+# Webhook deliveries against stub servers on loopback, over HTTP and over
+# HTTPS with a self-signed certificate for localhost, through connections
+# pinned to the address the outbound policy checked.
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from os import path
+import ssl
+import pytest
+
+CERTIFICATE = path.join(path.dirname(path.abspath(__file__)), 'localhost.pem')
+
+class StubHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.received.append((self.command, self.path, self.headers['Host'], body))
+        self.send_response(204)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+@pytest.fixture(params=["http", "https"])
+def stub(request):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.received = []
+    if request.param == "https":
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(CERTIFICATE)
+        server.socket = context.wrap_socket(server.socket, server_side=True)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield request.param, server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def dispatcher(app):
+    from application.pool import ConnectionPool
+    from application.webhooks import WebhookDispatcher
+    dispatcher = WebhookDispatcher(app)
+    # The pool start() would make, trusting the stub's certificate
+    dispatcher.pool = ConnectionPool(timeout=dispatcher.timeout, policy=dispatcher.policy,
+        context=ssl.create_default_context(cafile=CERTIFICATE))
+    yield dispatcher
+    dispatcher.pool.close()
+
+def test_delivery_reaches_stub(stub, dispatcher):
+    from application.webhooks import Delivery
+    scheme, server = stub
+    port = server.server_address[1]
+    # localhost may resolve to ::1 first, which the policy skips
+    url = "{}://localhost:{}/hook".format(scheme, port)
+    dispatcher.in_flight.add(1)
+    dispatcher.deliver(Delivery(1, url, "POST", b'{"status": "hi"}', 0))
+    assert dispatcher.results[1][0] == 204
+    assert not dispatcher.in_flight
+    assert server.received == [("POST", "/hook", "localhost:{}".format(port), b'{"status": "hi"}')]
+
+def test_refused_delivery_is_final(dispatcher):
+    from application.webhooks import Delivery
+    # The metadata address is link-local, outside OUTBOUND_ALLOW
+    dispatcher.in_flight.add(2)
+    dispatcher.deliver(Delivery(2, "http://169.254.169.254/latest", "GET", None, 0))
+    assert dispatcher.results[2][0] == 0
+    assert not dispatcher.in_flight and not dispatcher.queue
+
+def test_failed_delivery_releases_webhook(dispatcher):
+    from application.webhooks import Delivery
+    class BrokenPool:
+        def request(self, *args, **kwargs):
+            raise TypeError("broken")
+
+        def close(self):
+            pass
+    dispatcher.pool = BrokenPool()
+    dispatcher.in_flight.add(3)
+    dispatcher.deliver(Delivery(3, "http://localhost/", "GET", None, 0))
+    assert dispatcher.results[3][0] == 0
+    assert not dispatcher.in_flight
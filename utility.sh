@@ -1,4 +1,4 @@
 #! /bin/bash
 
 export FLASK_APP=cli.py
-flask $1 $2 $3
+flask "$@"